@@ -1,25 +1,55 @@
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
 from pathlib import Path
+import json
 import sys
 
 # Add the current directory to the Python path so we can import chatbot
 sys.path.append(str(Path(__file__).parent.resolve()))
 
-from chatbot import ask_question_web, _refresh_if_changed, _ensure_chunks_loaded, _train_index, feed_knowledge_to_llama
+from chatbot import (ask_question_web, ask_question_stream, get_web_cache_stats, get_answer_cache_stats,
+                     get_index_status, get_scheduler_stats, check_ollama_capacity, OllamaBusyError,
+                     _refresh_if_changed, start_warm_up, is_ready, get_startup_status, get_ollama_stats,
+                     get_ollama_pool,
+                     answer_batch, parse_batch_lines, BATCH_MAX_QUESTIONS, STARTUP_RETRY_AFTER)
+from metrics import render_metrics, request_trace, span
 
 app = Flask(__name__)
 
-# Initialize the chatbot on startup
+# Load the index and warm up the model; in fast-start mode this runs in the
+# background and questions get a 503 until the index is ready
 print("Initializing chatbot...")
-_ensure_chunks_loaded()
-_train_index()
-_refresh_if_changed()
+start_warm_up()
 
-# Feed knowledge base to Llama for training
-success = feed_knowledge_to_llama()
-print("✓ Llama trained with knowledge base" if success else "⚠ Warning: Could not train Llama with knowledge base")
-print("Chatbot ready!")
+def _busy_response(error: OllamaBusyError):
+    """Reject a request because Ollama is saturated, telling the client when to retry."""
+    response = jsonify({
+        'error': f'The assistant is busy, please retry in {error.retry_after} seconds',
+        'answer': '',
+        'sources': [],
+        'web_sources': [],
+        'retry_after': error.retry_after
+    })
+    response.status_code = error.status
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def _starting_response():
+    """Turn a question away while the index is still loading."""
+    response = jsonify({
+        'error': f'The assistant is starting up, please retry in {STARTUP_RETRY_AFTER} seconds',
+        'answer': '',
+        'sources': [],
+        'web_sources': [],
+        'retry_after': STARTUP_RETRY_AFTER
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(STARTUP_RETRY_AFTER)
+    return response
+
+def _wants_debug(data: dict) -> bool:
+    """Whether the client asked for per-stage timings in the response."""
+    return bool(data.get('debug')) or request.args.get('debug') == '1'
 
 @app.route('/')
 def index():
@@ -30,12 +60,14 @@ def index():
 def ask():
     """Handle question submission and return answer with sources."""
     try:
-        data = request.get_json()
-        question = data.get('question', '').strip()
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            data = {}
+        question = str(data.get('question') or '').strip()
         source_type = data.get('sourceType', 'knowledge')
         
         # Validate source type
-        if source_type not in ['knowledge', 'web']:
+        if source_type not in ['knowledge', 'web', 'both']:
             source_type = 'knowledge'
         
         if not question:
@@ -46,12 +78,20 @@ def ask():
                 'web_sources': []
             }), 400
         
+        if not is_ready():
+            return _starting_response()
+        
         # Refresh knowledge if changed and get answer
-        _refresh_if_changed()
-        result = ask_question_web(question, source_type)
+        with request_trace() as trace, span("total"):
+            _refresh_if_changed()
+            result = ask_question_web(question, source_type)
         
+        if _wants_debug(data):
+            result = {**result, 'debug': trace}
         return jsonify(result)
         
+    except OllamaBusyError as e:
+        return _busy_response(e)
     except Exception as e:
         return jsonify({
             'error': f'An error occurred: {str(e)}',
@@ -60,12 +100,136 @@ def ask():
             'web_sources': []
         }), 500
 
+@app.route('/ask/stream', methods=['POST'])
+def ask_stream():
+    """Handle question submission and stream the answer as Server-Sent Events.
+    
+    Emits a "token" event for each generated piece of text and a final "done"
+    event with the same answer, sources and confidence fields as /ask.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    question = str(data.get('question') or '').strip()
+    source_type = data.get('sourceType', 'knowledge')
+    debug = _wants_debug(data)
+    
+    # Validate source type
+    if source_type not in ['knowledge', 'web', 'both']:
+        source_type = 'knowledge'
+    
+    if not question:
+        return jsonify({
+            'error': 'Please enter a question',
+            'answer': '',
+            'sources': [],
+            'web_sources': []
+        }), 400
+    
+    # Reject before the event stream starts, while a status code can still be sent
+    if not is_ready():
+        return _starting_response()
+    try:
+        check_ollama_capacity()
+    except OllamaBusyError as e:
+        return _busy_response(e)
+    
+    def generate():
+        try:
+            with request_trace() as trace:
+                with span("total"):
+                    _refresh_if_changed()
+                    for event, payload in ask_question_stream(question, source_type):
+                        if event == "token":
+                            yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+                        else:
+                            final = (event, payload)
+                event, payload = final
+                if debug:
+                    payload = {**payload, 'debug': trace}
+                yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+        except OllamaBusyError as e:
+            error = {'error': f'The assistant is busy, please retry in {e.retry_after} seconds',
+                     'answer': '', 'sources': [], 'web_sources': [], 'retry_after': e.retry_after}
+            yield f"event: error\ndata: {json.dumps(error)}\n\n"
+        except Exception as e:
+            error = {'error': f'An error occurred: {str(e)}', 'answer': '', 'sources': [], 'web_sources': []}
+            yield f"event: error\ndata: {json.dumps(error)}\n\n"
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/ask/batch', methods=['POST'])
+def ask_batch():
+    """Answer a JSONL batch of questions, streaming back one JSON result per line.
+    
+    Each input line is {"question": ..., "sourceType": ..., "id": ...} or a bare
+    question string. Results arrive as they complete, tagged with the line's
+    position ("index") and id, so callers should not rely on their order.
+    """
+    items = parse_batch_lines(request.get_data(as_text=True).splitlines())
+    if not items:
+        return jsonify({'error': 'Send one question per line'}), 400
+    if len(items) > BATCH_MAX_QUESTIONS:
+        return jsonify({'error': f'A batch may hold at most {BATCH_MAX_QUESTIONS} questions'}), 413
+    if not is_ready():
+        return _starting_response()
+    
+    def generate():
+        try:
+            _refresh_if_changed()
+            for result in answer_batch(items):
+                yield json.dumps(result) + "\n"
+        except Exception as e:
+            yield json.dumps({'error': f'An error occurred: {str(e)}'}) + "\n"
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'X-Accel-Buffering': 'no'})
+
 @app.route('/health')
 def health():
-    """Health check endpoint."""
-    return jsonify({'status': 'ok', 'message': 'Chatbot is running'})
+    """Health check endpoint; 'startup' reports liveness, readiness and warm-up progress."""
+    return jsonify({'status': 'ok', 'message': 'Chatbot is running', 'startup': get_startup_status(),
+                    'index': get_index_status(),
+                    'web_cache': get_web_cache_stats(),
+                    'answer_cache': get_answer_cache_stats(),
+                    'ollama': get_ollama_stats(),
+                    'scheduler': get_scheduler_stats()})
+
+@app.route('/health/live')
+def health_live():
+    """Liveness probe: the process is up and serving requests."""
+    return jsonify({'status': 'live'})
+
+@app.route('/health/ready')
+def health_ready():
+    """Readiness probe: 200 once questions can be answered, 503 while the index is loading."""
+    status = get_startup_status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/metrics')
+def metrics():
+    """Expose per-stage latency and token histograms in the Prometheus text format."""
+    scheduler = get_scheduler_stats()
+    answer_cache = get_answer_cache_stats()
+    gauges = {
+        'rag_ready': ('Whether the index has loaded and questions are being answered.', int(is_ready())),
+        'rag_index_chunks': ('Chunks in the current knowledge index.', get_index_status()['chunks']),
+        'rag_ollama_in_flight': ('Ollama generations currently running.', scheduler['in_flight']),
+        'rag_ollama_queue_depth': ('Requests waiting for an Ollama slot.', scheduler['queue_depth']),
+        'rag_ollama_rejected_total': ('Requests rejected by the Ollama scheduler.',
+                                      scheduler['rejected_full'] + scheduler['rejected_deadline']),
+        'rag_ollama_backends_available': ('Ollama backends in rotation (circuit not open).',
+                                          get_ollama_pool().available_count()),
+        'rag_answer_cache_hits_total': ('Answers served from the answer cache.',
+                                        answer_cache['exact_hits'] + answer_cache['similar_hits'])
+    }
+    for name, stats in get_web_cache_stats().items():
+        gauges[f'rag_{name}_cache_hit_rate'] = (f'Hit rate of the {name} cache.', stats['hit_rate'])
+    return Response(render_metrics(gauges), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     print("Starting Flask chatbot server...")
     print("Visit http://localhost:5000 to use the chatbot")
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    # Requests are served on separate threads; the index is shared as an immutable snapshot
+    app.run(debug=True, host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
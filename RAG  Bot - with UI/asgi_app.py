@@ -0,0 +1,523 @@
+"""
+Async Chatbot Server
+An ASGI (Starlette) version of app.py. Ollama calls, web searches and page
+scrapes go through an async HTTP client, so a request waiting on the model or
+the network holds no thread and one process can keep hundreds of them open.
+Retrieval, caching and prompt building are shared with the Flask app.
+
+Run with:
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+"""
+
+import json
+import time
+import asyncio
+import urllib.parse
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import httpx
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from starlette.templating import Jinja2Templates
+
+import chatbot
+from html_extract import FEED_BYTES, MainTextExtractor, charset_from_content_type
+from metrics import render_metrics, request_trace, span
+from ollama_client import OllamaUnavailableError
+from scheduler import OllamaBusyError
+
+ASYNC_MAX_QUEUE = 512  # Requests allowed to wait for an Ollama slot (no thread is held while waiting)
+HTTP_POOL_SIZE = 100  # Connections kept by the async HTTP client
+
+# The same scheduler as chatbot's, so /ask tasks and batch threads share one in-flight limit
+_SCHEDULER = chatbot._OLLAMA_SCHEDULER
+_SCHEDULER.max_queue = max(_SCHEDULER.max_queue, ASYNC_MAX_QUEUE)
+_HOST_LIMITERS = {}
+_BACKGROUND_TASKS = set()  # Page fetches that outlived their request's deadline
+_client = None
+_templates = Jinja2Templates(directory=str(Path(__file__).parent / 'templates'))
+
+
+class _AsyncHostLimiter:
+    """Async counterpart of chatbot._HostLimiter: bounded concurrency and spacing per host."""
+
+    def __init__(self):
+        self._slots = asyncio.Semaphore(chatbot.PER_HOST_CONCURRENCY)
+        self._next_start = 0.0
+        self.users = 0  # Requests holding or waiting for the limiter
+
+    def idle(self, now: float) -> bool:
+        """Whether forgetting the limiter cannot let a request start early."""
+        return not self.users and now >= self._next_start
+
+    async def __aenter__(self):
+        self.users += 1
+        try:
+            await self._slots.acquire()
+        except BaseException:
+            self.users -= 1
+            raise
+        now = time.monotonic()
+        start = max(now, self._next_start)
+        self._next_start = start + chatbot.PER_HOST_INTERVAL
+        try:
+            await asyncio.sleep(start - now)
+        except BaseException:
+            await self.__aexit__()  # Cancelled while spacing the start
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._slots.release()
+        self.users -= 1
+
+
+def _host_limiter(url: str) -> _AsyncHostLimiter:
+    """Return the limiter for the URL's host, forgetting idle hosts once too many are tracked."""
+    host = urllib.parse.urlparse(url).netloc
+    limiter = _HOST_LIMITERS.get(host)
+    if limiter is None:
+        if len(_HOST_LIMITERS) >= chatbot.PER_HOST_MAX_TRACKED:
+            chatbot._forget_idle_hosts(_HOST_LIMITERS)
+        limiter = _HOST_LIMITERS[host] = _AsyncHostLimiter()
+    return limiter
+
+
+async def _http_get(url: str, timeout: float = 10) -> httpx.Response:
+    """GET a URL through the shared async client, respecting the per-host limits."""
+    async with _host_limiter(url):
+        response = await _client.get(url, timeout=timeout)
+    response.raise_for_status()
+    return response
+
+
+async def _search_web(query: str, num_results: int = 3) -> list:
+    """Search for URLs using DuckDuckGo, sharing the search cache with the sync path."""
+    with span("web_search"):
+        cache_key = f"{num_results}:{chatbot._normalize_query(query)}"
+        urls = chatbot._SEARCH_CACHE.get(cache_key)
+        if urls is not None:
+            return urls
+
+        try:
+            response = await _http_get(f"{chatbot.SEARCH_URL}?q={urllib.parse.quote_plus(query)}", timeout=10)
+            urls = await asyncio.to_thread(chatbot._parse_search_results, response.content, num_results)
+        except Exception as e:
+            print(f"[Error searching web: {e}]")
+            return []
+        if urls:
+            chatbot._SEARCH_CACHE.set(cache_key, urls)
+        return urls
+
+
+async def _stream_page_text(url: str, timeout: float) -> str:
+    """Download a page and extract its main text, stopping once enough has arrived (see chatbot._read_page_text)."""
+    async with _host_limiter(url):
+        async with _client.stream('GET', url, timeout=timeout) as response:
+            response.raise_for_status()
+            extractor = MainTextExtractor(chatbot.WEB_PAGE_TEXT_CHARS,
+                                          charset_from_content_type(response.headers.get('Content-Type')))
+            received = 0
+            # lxml parses each piece in C, so feeding it on the event loop is cheap
+            async for chunk in response.aiter_bytes(FEED_BYTES):
+                received += len(chunk)
+                if extractor.feed(chunk) or received >= chatbot.WEB_MAX_PAGE_BYTES:
+                    break
+    return extractor.text()
+
+
+async def _fetch_webpage(url: str, timeout: float = 10) -> str:
+    """Download, clean and cache the text content of a webpage."""
+    with span("scrape"):
+        try:
+            text = await _stream_page_text(url, timeout)
+        except Exception as e:
+            print(f"[Error scraping {url}: {e}]")
+            return ""
+        if text:
+            chatbot._PAGE_CACHE.set(url, text)
+        return text
+
+
+async def _scrape_webpages(urls: list, deadline: float = None) -> list:
+    """Scrape several pages concurrently and return (url, content) pairs in search order.
+
+    Pages still loading at the deadline are left out but keep downloading in
+    the background, so they land in the page cache for the next request.
+    """
+    deadline = chatbot.WEB_FETCH_DEADLINE if deadline is None else deadline
+    pages = {url: chatbot._PAGE_CACHE.get(url) for url in urls}
+    tasks = {url: asyncio.create_task(_fetch_webpage(url, min(10, deadline))) for url in urls if pages[url] is None}
+
+    if tasks:
+        try:
+            done, pending = await asyncio.wait(tasks.values(), timeout=deadline)
+        except asyncio.CancelledError:
+            # A cancelled speculative lookup stops its downloads too
+            for task in tasks.values():
+                task.cancel()
+            raise
+        if pending:
+            print(f"[Web fetch deadline reached, skipping {len(pending)} slow page(s)]")
+        for url, task in tasks.items():
+            pages[url] = task.result() if task in done else None
+        for task in pending:
+            _BACKGROUND_TASKS.add(task)
+            task.add_done_callback(_BACKGROUND_TASKS.discard)
+
+    return [(url, pages[url]) for url in urls if pages[url]]
+
+
+async def _fetch_web_pages(question: str, delay: float = 0) -> list:
+    """Search the web and scrape the top results into (url, text) pairs, as chatbot._fetch_web_pages does.
+
+    delay holds the search back so a speculative lookup can be cancelled before it sends anything.
+    """
+    if not chatbot.ENABLE_WEB_SCRAPING:
+        return []
+    if delay:
+        await asyncio.sleep(delay)
+
+    urls = await _search_web(question)
+    if not urls:
+        print("[No web results found or no internet connection]")
+        return []
+    return await _scrape_webpages(urls)
+
+
+async def _get_web_context_with_sources(question: str) -> tuple:
+    """Get web context and source URLs, as chatbot._get_web_context_with_sources does."""
+    return chatbot._pack_web_context(question, await _fetch_web_pages(question))
+
+
+async def _plan_both(question: str, index) -> dict:
+    """Plan a 'both' answer (see chatbot._plan_answer), cancelling the web lookup if the knowledge base suffices."""
+    lookup = asyncio.create_task(_fetch_web_pages(question, chatbot.WEB_SPECULATION_DELAY))
+    try:
+        built, confidence = await asyncio.to_thread(chatbot._assess_knowledge, question, index)
+    except BaseException:
+        lookup.cancel()
+        raise
+    if confidence >= chatbot.KNOWLEDGE_CONFIDENCE_THRESHOLD:
+        lookup.cancel()
+        print(f"[Knowledge Base Confidence: {confidence:.2f}, skipping the web]")
+        return chatbot._knowledge_plan(question, built, confidence, index)
+
+    print(f"[Knowledge Base Confidence ({confidence:.2f}) below threshold, waiting for the web]")
+    try:
+        pages = await lookup
+    except Exception as e:
+        print(f"[Web scraping failed: {e}]")
+        pages = []
+    return await asyncio.to_thread(chatbot._hybrid_plan, question, built, confidence, pages, index)
+
+
+async def _ollama_request(plan: dict) -> dict:
+    """Generate an answer for a plan's prompt, returning Ollama's reply or {"error": ...}."""
+    payload = chatbot._build_chat_payload(plan["prompt"], 0.5, plan["num_predict"], stream=False)
+    async with _SCHEDULER.async_slot():
+        with span("ollama"):
+            try:
+                async with chatbot.get_ollama_pool().request_async(_client, '/api/chat', payload,
+                                                                   plan["timeout"]) as response:
+                    response.raise_for_status()
+                    result = response.json()
+            except (httpx.HTTPError, OllamaUnavailableError, ValueError) as e:
+                return {"error": str(e)}
+            result["response"] = result.get("message", {}).get("content", "")
+            chatbot._record_ollama_timings(result)
+            return result
+
+
+async def _ollama_stream(plan: dict):
+    """Stream a plan's generation, yielding parsed NDJSON chunks or a single {"error": ...}."""
+    payload = chatbot._build_chat_payload(plan["prompt"], 0.5, plan["num_predict"], stream=True)
+    async with _SCHEDULER.async_slot():
+        with span("ollama"):
+            try:
+                async with chatbot.get_ollama_pool().request_async(_client, '/api/chat', payload, plan["timeout"],
+                                                                   stream=True) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line:
+                            continue
+                        chunk = json.loads(line)
+                        if "error" in chunk:
+                            yield {"error": chunk["error"]}
+                            return
+                        chunk["response"] = chunk.get("message", {}).get("content", "")
+                        yield chunk
+                        if chunk.get("done"):
+                            chatbot._record_ollama_timings(chunk)
+                            return
+            except (httpx.HTTPError, OllamaUnavailableError, ValueError) as e:
+                yield {"error": str(e)}
+
+
+async def _prepare(question: str, source_type: str) -> tuple:
+    """Look up the answer cache and plan the answer, returning (index, cached, key, vector, plan)."""
+    await asyncio.to_thread(chatbot._refresh_if_changed)
+    index = chatbot._current_index()
+    cached, cache_key, vector = await asyncio.to_thread(chatbot._lookup_answer_cache, question, source_type, index)
+    if cached is not None:
+        return index, cached, None, None, None
+
+    if source_type == 'both':
+        return index, None, cache_key, vector, await _plan_both(question, index)
+
+    web = None
+    if source_type == 'web':
+        web = await _get_web_context_with_sources(question)
+    plan = await asyncio.to_thread(chatbot._plan_answer, question, source_type, index, web)
+    return index, None, cache_key, vector, plan
+
+
+def _parse_question(data: dict) -> tuple:
+    question = str(data.get('question') or '').strip()
+    source_type = data.get('sourceType', 'knowledge')
+    if source_type not in ['knowledge', 'web', 'both']:
+        source_type = 'knowledge'
+    return question, source_type
+
+
+def _wants_debug(request: Request, data: dict) -> bool:
+    return bool(data.get('debug')) or request.query_params.get('debug') == '1'
+
+
+def _empty_question_response() -> JSONResponse:
+    return JSONResponse({'error': 'Please enter a question', 'answer': '', 'sources': [], 'web_sources': []},
+                        status_code=400)
+
+
+def _starting_response() -> JSONResponse:
+    """Turn a question away while the index is still loading."""
+    retry_after = chatbot.STARTUP_RETRY_AFTER
+    return JSONResponse({
+        'error': f'The assistant is starting up, please retry in {retry_after} seconds',
+        'answer': '',
+        'sources': [],
+        'web_sources': [],
+        'retry_after': retry_after
+    }, status_code=503, headers={'Retry-After': str(retry_after)})
+
+
+def _busy_response(error: OllamaBusyError) -> JSONResponse:
+    """Reject a request because Ollama is saturated, telling the client when to retry."""
+    return JSONResponse({
+        'error': f'The assistant is busy, please retry in {error.retry_after} seconds',
+        'answer': '',
+        'sources': [],
+        'web_sources': [],
+        'retry_after': error.retry_after
+    }, status_code=error.status, headers={'Retry-After': str(error.retry_after)})
+
+
+async def index(request: Request):
+    """Serve the main chatbot interface."""
+    return _templates.TemplateResponse(request, 'index.html')
+
+
+async def ask(request: Request):
+    """Handle question submission and return answer with sources."""
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+    question, source_type = _parse_question(data)
+    if not question:
+        return _empty_question_response()
+    if not chatbot.is_ready():
+        return _starting_response()
+
+    try:
+        with request_trace() as trace, span("total"):
+            index, cached, cache_key, vector, plan = await _prepare(question, source_type)
+            if cached is not None:
+                result = cached
+            elif "result" in plan:
+                result = plan["result"]
+            else:
+                reply = await _ollama_request(plan)
+                if "error" in reply:
+                    result = chatbot._error_result(reply["error"])
+                else:
+                    result = chatbot._finalize_answer(reply.get('response', ''), plan)
+                    if cache_key is not None:
+                        chatbot._ANSWER_CACHE.set(cache_key, vector, result, index.snapshot)
+    except OllamaBusyError as e:
+        return _busy_response(e)
+    except Exception as e:
+        return JSONResponse({'error': f'An error occurred: {str(e)}', 'answer': '', 'sources': [], 'web_sources': []},
+                            status_code=500)
+
+    if _wants_debug(request, data):
+        result = {**result, 'debug': trace}
+    return JSONResponse(result)
+
+
+async def ask_stream(request: Request):
+    """Handle question submission and stream the answer as Server-Sent Events (see app.py)."""
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+    question, source_type = _parse_question(data)
+    if not question:
+        return _empty_question_response()
+    debug = _wants_debug(request, data)
+    if not chatbot.is_ready():
+        return _starting_response()
+
+    try:
+        _SCHEDULER.check_capacity()
+    except OllamaBusyError as e:
+        return _busy_response(e)
+
+    def sse(event: str, payload: dict) -> str:
+        return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+    async def generate():
+        with request_trace() as trace:
+            try:
+                with span("total"):
+                    index, cached, cache_key, vector, plan = await _prepare(question, source_type)
+                    if cached is not None:
+                        event, result = "done", cached
+                    elif "result" in plan:
+                        event, result = "done", plan["result"]
+                    else:
+                        pieces = []
+                        event = None
+                        async for chunk in _ollama_stream(plan):
+                            if "error" in chunk:
+                                event, result = "error", chatbot._error_result(chunk["error"])
+                                break
+                            text = chunk.get('response', '')
+                            if text:
+                                pieces.append(text)
+                                yield sse("token", {"text": text})
+                        if event is None:
+                            event, result = "done", chatbot._finalize_answer("".join(pieces), plan)
+                            if cache_key is not None:
+                                chatbot._ANSWER_CACHE.set(cache_key, vector, result, index.snapshot)
+            except OllamaBusyError as e:
+                event, result = "error", {'error': f'The assistant is busy, please retry in {e.retry_after} seconds',
+                                          'answer': '', 'sources': [], 'web_sources': [],
+                                          'retry_after': e.retry_after}
+            except Exception as e:
+                event, result = "error", {'error': f'An error occurred: {str(e)}', 'answer': '',
+                                          'sources': [], 'web_sources': []}
+            if debug:
+                result = {**result, 'debug': trace}
+            yield sse(event, result)
+
+    return StreamingResponse(generate(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+async def ask_batch(request: Request):
+    """Answer a JSONL batch of questions, streaming back one JSON result per line (see app.py).
+
+    The batch runs chatbot.answer_batch on a worker thread. Its generations
+    wait for slots in the same scheduler as /ask, so together they never
+    exceed the Ollama in-flight limit.
+    """
+    body = await request.body()
+    items = chatbot.parse_batch_lines(body.decode('utf-8', errors='replace').splitlines())
+    if not items:
+        return JSONResponse({'error': 'Send one question per line'}, status_code=400)
+    if len(items) > chatbot.BATCH_MAX_QUESTIONS:
+        return JSONResponse({'error': f'A batch may hold at most {chatbot.BATCH_MAX_QUESTIONS} questions'},
+                            status_code=413)
+    if not chatbot.is_ready():
+        return _starting_response()
+
+    def generate():
+        try:
+            chatbot._refresh_if_changed()
+            for result in chatbot.answer_batch(items):
+                yield json.dumps(result) + "\n"
+        except Exception as e:
+            yield json.dumps({'error': f'An error occurred: {str(e)}'}) + "\n"
+
+    # Starlette iterates a plain generator on its thread pool
+    return StreamingResponse(generate(), media_type='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+
+
+async def health(request: Request):
+    """Health check endpoint; 'startup' reports liveness, readiness and warm-up progress."""
+    return JSONResponse({'status': 'ok', 'message': 'Chatbot is running', 'startup': chatbot.get_startup_status(),
+                         'index': chatbot.get_index_status(),
+                         'web_cache': chatbot.get_web_cache_stats(),
+                         'answer_cache': chatbot.get_answer_cache_stats(),
+                         'ollama': chatbot.get_ollama_stats(),
+                         'scheduler': _SCHEDULER.stats()})
+
+
+async def health_live(request: Request):
+    """Liveness probe: the process is up and serving requests."""
+    return JSONResponse({'status': 'live'})
+
+
+async def health_ready(request: Request):
+    """Readiness probe: 200 once questions can be answered, 503 while the index is loading."""
+    status = chatbot.get_startup_status()
+    return JSONResponse(status, status_code=200 if status['ready'] else 503)
+
+
+async def metrics(request: Request):
+    """Expose per-stage latency and token histograms in the Prometheus text format."""
+    scheduler = _SCHEDULER.stats()
+    gauges = {
+        'rag_ready': ('Whether the index has loaded and questions are being answered.', int(chatbot.is_ready())),
+        'rag_index_chunks': ('Chunks in the current knowledge index.', chatbot.get_index_status()['chunks']),
+        'rag_ollama_in_flight': ('Ollama generations currently running.', scheduler['in_flight']),
+        'rag_ollama_queue_depth': ('Requests waiting for an Ollama slot.', scheduler['queue_depth']),
+        'rag_ollama_backends_available': ('Ollama backends in rotation (circuit not open).',
+                                          chatbot.get_ollama_pool().available_count())
+    }
+    return Response(render_metrics(gauges), media_type='text/plain; version=0.0.4')
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global _client
+    _client = httpx.AsyncClient(
+        headers={'User-Agent': chatbot._USER_AGENT},
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
+    )
+    # In fast-start mode the index and model load in the background and the server starts at once
+    print("Initializing chatbot...")
+    await asyncio.to_thread(chatbot.start_warm_up)
+    try:
+        yield
+    finally:
+        chatbot.stop_corpus_watcher()
+        await _client.aclose()
+
+
+app = Starlette(routes=[
+    Route('/', index),
+    Route('/ask', ask, methods=['POST']),
+    Route('/ask/stream', ask_stream, methods=['POST']),
+    Route('/ask/batch', ask_batch, methods=['POST']),
+    Route('/health', health),
+    Route('/health/live', health_live),
+    Route('/health/ready', health_ready),
+    Route('/metrics', metrics)
+], lifespan=lifespan)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    print("Starting async chatbot server...")
+    print("Visit http://localhost:5000 to use the chatbot")
+    uvicorn.run(app, host='0.0.0.0', port=5000)
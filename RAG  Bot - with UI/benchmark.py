@@ -0,0 +1,408 @@
+"""
+RAG Pipeline Benchmark
+Generates a synthetic knowledge corpus, serves local stand-ins for Ollama and
+the DuckDuckGo/web page fetches, replays a question set through the pipeline
+and reports per-stage latency percentiles, throughput, peak memory and index
+build time. Results can be saved as a baseline and later runs compared to it.
+
+Usage:
+    python benchmark.py --chunks 20000 --questions 200 --save-baseline
+    python benchmark.py --chunks 20000 --questions 200 --compare
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import contextlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+import chatbot
+from index_store import chunk_hash
+from ingest import chunk_text, iter_chunks
+
+BASELINE_FILE = 'benchmark_baseline.json'
+REGRESSION_TOLERANCE = 0.10  # Relative slowdown reported as a regression
+_TOPICS = ['volcano', 'earthquake', 'ocean', 'glacier', 'desert', 'forest', 'river', 'storm',
+           'planet', 'comet', 'galaxy', 'reef', 'canyon', 'island', 'tundra', 'monsoon']
+_WORDS = ['magma', 'pressure', 'plate', 'fault', 'current', 'salinity', 'erosion', 'sediment',
+          'climate', 'orbit', 'gravity', 'radiation', 'nutrient', 'species', 'habitat', 'rainfall',
+          'temperature', 'layer', 'surface', 'crust', 'mantle', 'atmosphere', 'ice', 'wind',
+          'energy', 'cycle', 'season', 'altitude', 'mineral', 'carbon', 'oxygen', 'tide']
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    """Stand-in for the Ollama API and the web search/page endpoints."""
+    protocol_version = 'HTTP/1.1'
+    llm_delay = 0.0  # Seconds before the first token
+    token_delay = 0.0  # Seconds between streamed tokens
+    page_delay = 0.0  # Seconds to serve a search or page request
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (ConnectionResetError, BrokenPipeError):
+            pass  # The client stopped reading early, as the streaming page extractor does
+
+    def _send(self, body: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        chat = self.path.endswith('/api/chat')
+        words = ["This", " is", " a", " synthetic", " answer", " about", " the", " context", "."]
+        stats = {"prompt_eval_count": 100, "eval_count": len(words),
+                 "prompt_eval_duration": 1000000, "eval_duration": 1000000}
+        time.sleep(self.llm_delay)
+
+        def message(text):
+            return {"message": {"role": "assistant", "content": text}} if chat else {"response": text}
+
+        if not payload.get('stream'):
+            time.sleep(self.token_delay * len(words))
+            body = json.dumps({**message("".join(words)), "done": True, **stats}).encode()
+            self._send(body, 'application/json')
+            return
+
+        lines = []
+        for word in words:
+            lines.append(json.dumps({**message(word), "done": False}))
+        lines.append(json.dumps({**message(""), "done": True, **stats}))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for line in lines:
+            time.sleep(self.token_delay)
+            data = (line + "\n").encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def do_GET(self):
+        time.sleep(self.page_delay)
+        host = f"http://127.0.0.1:{self.server.server_port}"
+        if self.path.startswith('/html/'):
+            links = "".join(f'<a class="result__a" href="{host}/page/{i}">Result {i}</a>' for i in range(5))
+            self._send(f"<html><body>{links}</body></html>".encode(), 'text/html')
+            return
+
+        paragraphs = "".join(f"<p>{_sentence(random.Random(self.path + str(i)))}</p>" for i in range(20))
+        page = (f"<html><head><script>var x = 1;</script></head><body><nav>Home | About</nav>"
+                f"<article>{paragraphs}</article><footer>Copyright</footer></body></html>")
+        self._send(page.encode(), 'text/html')
+
+
+def _sentence(rng: random.Random) -> str:
+    topic = rng.choice(_TOPICS)
+    words = rng.sample(_WORDS, 6)
+    return f"The {topic} {words[0]} affects the {words[1]} and {words[2]} near the {words[3]} {words[4]} {words[5]}."
+
+
+def generate_corpus(path: str, chunks: int, seed: int = 0) -> int:
+    """Write a synthetic corpus of roughly the given number of chunks and return its size in bytes."""
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        for _ in range(chunks):
+            # About 300 characters per paragraph, i.e. one chunk each
+            f.write(" ".join(_sentence(rng) for _ in range(3)) + "\n\n")
+    return os.path.getsize(path)
+
+
+def generate_text(megabytes: float, seed: int = 2) -> str:
+    """Return about the given number of megabytes of synthetic paragraphs, including decimals and quotes."""
+    rng = random.Random(seed)
+    paragraphs = []
+    size = 0
+    while size < megabytes * 1024 * 1024:
+        paragraph = (" ".join(_sentence(rng) for _ in range(rng.randint(2, 6)))
+                     + f' It measured {rng.uniform(0, 100):.1f} units. "Remarkable," they said.\n\n')
+        paragraphs.append(paragraph)
+        size += len(paragraph)
+    return "".join(paragraphs)
+
+
+def generate_questions(count: int, seed: int = 1) -> list:
+    """Return questions phrased from the corpus vocabulary, some with no good match."""
+    rng = random.Random(seed)
+    questions = []
+    for i in range(count):
+        words = rng.sample(_WORDS, 2)
+        if i % 10 == 9:
+            questions.append(f"Who won the {rng.randint(1950, 2020)} football championship?")
+        else:
+            questions.append(f"How does the {rng.choice(_TOPICS)} {words[0]} change the {words[1]}?")
+    return questions
+
+
+def _percentiles(samples: list) -> dict:
+    if not samples:
+        return {}
+    values = np.array(samples) * 1000
+    return {
+        "count": len(samples),
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(values.max())
+    }
+
+
+def _peak_rss_mb() -> float:
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class _Stage:
+    """Times one pipeline stage and records its Python allocation peak."""
+
+    def __init__(self, name: str, trace_memory: bool):
+        self.name = name
+        self.trace_memory = trace_memory
+        self.result = {}
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.result["seconds"] = time.perf_counter() - self._started
+        if self.trace_memory:
+            self.result["peak_alloc_mb"] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            tracemalloc.stop()
+        self.result["peak_rss_mb"] = _peak_rss_mb()
+
+
+def _replay(fn, questions: list, concurrency: int = 1) -> dict:
+    """Run fn over every question, returning latency percentiles and throughput."""
+    latencies = []
+    errors = 0
+
+    def timed(question):
+        started = time.perf_counter()
+        result = fn(question)
+        elapsed = time.perf_counter() - started
+        return elapsed, isinstance(result, dict) and bool(result.get("error"))
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            outcomes = list(executor.map(timed, questions))
+    else:
+        outcomes = [timed(question) for question in questions]
+    wall = time.perf_counter() - started
+
+    for elapsed, failed in outcomes:
+        latencies.append(elapsed)
+        errors += failed
+    return {**_percentiles(latencies), "throughput_qps": len(questions) / wall if wall else 0.0, "errors": errors}
+
+
+def run_benchmark(args) -> dict:
+    """Run every stage against a fresh synthetic corpus and return the report."""
+    workdir = tempfile.mkdtemp(prefix='rag-bench-')
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _MockHandler)
+    _MockHandler.llm_delay = args.llm_delay
+    _MockHandler.token_delay = args.token_delay
+    _MockHandler.page_delay = args.page_delay
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    # Extra mock Ollama servers; generations are spread across all of them
+    extra_servers = [ThreadingHTTPServer(('127.0.0.1', 0), _MockHandler) for _ in range(args.ollama_backends - 1)]
+    for extra in extra_servers:
+        threading.Thread(target=extra.serve_forever, daemon=True).start()
+
+    corpus_path = os.path.join(workdir, 'knowledge.txt')
+    chatbot.KNOWLEDGE_FILE = corpus_path
+    chatbot.KNOWLEDGE_DIR = None
+    chatbot.INDEX_DIR = os.path.join(workdir, 'index')
+    chatbot.set_ollama_backends([base_url] + [f"http://127.0.0.1:{extra.server_port}" for extra in extra_servers])
+    chatbot.SEARCH_URL = f"{base_url}/html/"
+    chatbot.PER_HOST_INTERVAL = 0  # Every mock page is on one host
+    chatbot._OLLAMA_SCHEDULER.max_queue = max(chatbot._OLLAMA_SCHEDULER.max_queue, args.concurrency)
+
+    report = {"config": vars(args).copy(), "stages": {}}
+    stages = report["stages"]
+    questions = generate_questions(args.questions)
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+
+    try:
+        with quiet:
+            size = generate_corpus(corpus_path, args.chunks)
+            report["corpus_bytes"] = size
+
+            with open(corpus_path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            with _Stage("chunking", args.trace_memory) as stage:
+                chunk_count = len(chunk_text(text))
+            stage.result.update(chunks=chunk_count, mb_per_s=size / (1024 * 1024) / stage.result["seconds"])
+            stages["chunking"] = stage.result
+            del text
+
+            if args.chunker_mb:
+                # Chunk spans and content ids for a large single document, as one ingest shard would
+                text = generate_text(args.chunker_mb)
+                with _Stage("chunking_large", args.trace_memory) as stage:
+                    chunk_count = sum(1 for _, chunk in iter_chunks(text) if chunk_hash(chunk))
+                stage.result.update(chunks=chunk_count, mb_per_s=args.chunker_mb / stage.result["seconds"])
+                stages["chunking_large"] = stage.result
+                del text
+
+            with _Stage("index_build", args.trace_memory) as stage:
+                chatbot._INDEX = None
+                chatbot._train_index()
+            stage.result["chunks"] = len(chatbot._INDEX.chunks)
+            stages["index_build"] = stage.result
+
+            with _Stage("index_load", args.trace_memory) as stage:
+                chatbot._INDEX = None
+                chatbot._train_index()
+            stages["index_load"] = stage.result
+
+            index = chatbot._current_index()
+            stages["retrieval"] = _replay(lambda q: chatbot._rank_chunks(q, chatbot.KNOWLEDGE_TOP_K, index), questions)
+            started = time.perf_counter()
+            chatbot.retrieve_relevant_batch(questions, chatbot.KNOWLEDGE_TOP_K)
+            batch_seconds = time.perf_counter() - started
+            stages["retrieval_batch"] = {"seconds": batch_seconds, "throughput_qps": len(questions) / batch_seconds}
+            stages["prompt_build"] = _replay(lambda q: chatbot.build_knowledge_prompt(q, index=index), questions)
+
+            chatbot._ANSWER_CACHE.invalidate(index.snapshot)
+            stages["answer_knowledge"] = _replay(lambda q: chatbot.ask_question_web(q, 'knowledge'), questions)
+            chatbot._ANSWER_CACHE.invalidate(index.snapshot)
+            stages["answer_knowledge_concurrent"] = _replay(
+                lambda q: chatbot.ask_question_web(q, 'knowledge'), questions, args.concurrency)
+            stages["answer_knowledge_cached"] = _replay(lambda q: chatbot.ask_question_web(q, 'knowledge'), questions)
+
+            web_questions = questions[:args.web_questions]
+            chatbot._SEARCH_CACHE.clear()
+            chatbot._PAGE_CACHE.clear()
+            stages["answer_web"] = _replay(lambda q: chatbot.ask_question_web(q, 'web'), web_questions)
+            stages["answer_web_cached"] = _replay(lambda q: chatbot.ask_question_web(q, 'web'), web_questions)
+
+            stream_questions = questions[:args.web_questions]
+            chatbot._ANSWER_CACHE.invalidate(index.snapshot)
+            stages["answer_stream"] = _replay(lambda q: list(chatbot.ask_question_stream(q, 'knowledge'))[-1][1],
+                                              stream_questions)
+            report["ollama_requests_per_backend"] = [backend["requests"]
+                                                     for backend in chatbot.get_ollama_pool().stats()]
+    finally:
+        server.shutdown()
+        for extra in extra_servers:
+            extra.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report["peak_rss_mb"] = _peak_rss_mb()
+    return report
+
+
+def _headline_metrics(report: dict) -> dict:
+    """Flatten the metrics that are compared against a baseline (lower is better)."""
+    metrics = {}
+    for stage, result in report["stages"].items():
+        for name in ('p50_ms', 'p95_ms', 'seconds', 'peak_alloc_mb'):
+            if name in result:
+                metrics[f"{stage}.{name}"] = result[name]
+    metrics["peak_rss_mb"] = report["peak_rss_mb"]
+    return metrics
+
+
+def compare_reports(current: dict, baseline: dict, tolerance: float = REGRESSION_TOLERANCE) -> list:
+    """Return (metric, baseline, current, relative change, regressed) rows for shared metrics."""
+    rows = []
+    baseline_metrics = _headline_metrics(baseline)
+    for name, value in _headline_metrics(current).items():
+        if name not in baseline_metrics:
+            continue
+        before = baseline_metrics[name]
+        change = (value - before) / before if before else 0.0
+        rows.append((name, before, value, change, change > tolerance))
+    return rows
+
+
+def print_report(report: dict):
+    print(f"Corpus: {report['corpus_bytes'] / (1024 * 1024):.1f} MB, "
+          f"{report['stages']['index_build']['chunks']} chunks, peak RSS {report['peak_rss_mb']:.0f} MB")
+    for stage, result in report["stages"].items():
+        parts = [f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}"
+                 for key, value in result.items()]
+        print(f"  {stage:<28} " + " ".join(parts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the RAG pipeline against local mock services.")
+    parser.add_argument('--chunks', type=int, default=5000, help="Approximate number of chunks in the corpus")
+    parser.add_argument('--chunker-mb', type=float, default=100, help="Size of the large chunking input in MB (0 to skip)")
+    parser.add_argument('--questions', type=int, default=100, help="Questions replayed per stage")
+    parser.add_argument('--web-questions', type=int, default=10, help="Questions replayed in web mode")
+    parser.add_argument('--concurrency', type=int, default=8, help="Threads for the concurrent stage")
+    parser.add_argument('--llm-delay', type=float, default=0.0, help="Mock Ollama latency before the first token")
+    parser.add_argument('--token-delay', type=float, default=0.0, help="Mock Ollama delay between tokens")
+    parser.add_argument('--ollama-backends', type=int, default=1, help="Mock Ollama servers to balance across")
+    parser.add_argument('--page-delay', type=float, default=0.0, help="Mock search/page response delay")
+    parser.add_argument('--trace-memory', action='store_true', help="Record per-stage allocation peaks (slows every stage, so compare traced runs only with traced runs)")
+    parser.add_argument('--baseline', default=BASELINE_FILE, help="Baseline file to save or compare against")
+    parser.add_argument('--save-baseline', action='store_true', help="Save this run as the baseline")
+    parser.add_argument('--compare', action='store_true', help="Compare this run against the baseline")
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE, help="Relative slowdown that counts as a regression")
+    parser.add_argument('--output', help="Also write the full report to this JSON file")
+    parser.add_argument('--verbose', action='store_true', help="Show the chatbot's own log output")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    regressed = False
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print(f"No baseline at {args.baseline}; run with --save-baseline first")
+        else:
+            with open(args.baseline, 'r', encoding='utf-8') as f:
+                baseline = json.load(f)
+            print(f"Compared with {args.baseline}:")
+            for name, before, value, change, worse in compare_reports(report, baseline, args.tolerance):
+                flag = "  REGRESSION" if worse else ""
+                print(f"  {name:<44} {before:10.3f} -> {value:10.3f} ({change:+.1%}){flag}")
+                regressed = regressed or worse
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+TTL/LRU Cache
+A thread-safe cache with an in-memory LRU tier and an optional on-disk tier,
+both bounded in size and expiring entries after a time-to-live.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from scipy import sparse
+
+# Words that never change what a question asks; every other word must match for a similar hit
+FILLER_WORDS = frozenset({"a", "an", "the", "is", "are", "was", "were", "am", "be", "do", "does", "did", "s", "please"})
+
+
+class TTLCache:
+    """Two-tier cache for JSON-serialisable values.
+
+    Lookups check memory first, then disk (if a directory is configured); disk
+    hits are promoted back into memory. Memory is bounded by entry count, disk
+    by total bytes, and the least recently used / oldest entries go first.
+    """
+
+    def __init__(self, name: str, ttl: float, max_entries: int = 256, disk_dir: str = None, max_disk_bytes: int = 0):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.disk_dir = os.path.join(disk_dir, name) if disk_dir else None
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+        self._disk_bytes = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_bytes = sum(entry.stat().st_size for entry in os.scandir(self.disk_dir))
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, key: str, default=None):
+        """Return the cached value for key, or default if it is missing or expired."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    return entry[1]
+                del self._entries[key]
+                self._stats["expired"] += 1
+
+        value = self._disk_get(key, now)
+        with self._lock:
+            if value is None:
+                self._stats["misses"] += 1
+                return default
+            self._stats["disk_hits"] += 1
+        return value
+
+    def set(self, key: str, value):
+        """Store value under key in both tiers."""
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+        self._disk_set(key, expires_at, value)
+
+    def clear(self):
+        """Drop every entry from both tiers."""
+        with self._lock:
+            self._entries.clear()
+        self._disk_bytes = 0
+        if self.disk_dir:
+            for name in os.listdir(self.disk_dir):
+                try:
+                    os.remove(os.path.join(self.disk_dir, name))
+                except OSError:
+                    pass
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and the current memory-tier size."""
+        with self._lock:
+            lookups = self._stats["memory_hits"] + self._stats["disk_hits"] + self._stats["misses"]
+            hits = lookups - self._stats["misses"]
+            return {
+                **self._stats,
+                "entries": len(self._entries),
+                "hit_rate": hits / lookups if lookups else 0.0
+            }
+
+    def _disk_get(self, key: str, now: float):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if record.get("key") != key:
+            return None
+        if record["expires_at"] <= now:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+        with self._lock:
+            self._entries[key] = (record["expires_at"], record["value"])
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+        return record["value"]
+
+    def _disk_set(self, key: str, expires_at: float, value):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"key": key, "expires_at": expires_at, "value": value}, f)
+            self._disk_bytes += os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"[Error writing {self.name} cache: {e}]")
+            return
+        # The running total over-counts replaced entries, so it only triggers a rescan
+        if self.max_disk_bytes and self._disk_bytes > self.max_disk_bytes:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        """Remove the oldest disk entries until the tier fits max_disk_bytes."""
+        files = []
+        total = 0
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith('.json'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                with self._lock:
+                    self._stats["evictions"] += 1
+            except OSError:
+                pass
+        self._disk_bytes = total
+
+
+class SemanticAnswerCache:
+    """LRU cache of answers looked up by question similarity.
+
+    Questions are stored as L2-normalised sparse vectors (e.g. TF-IDF rows), so
+    a lookup is a single sparse dot product against the cached questions. The
+    vectors ignore stop words and unknown terms, so a similar hit must also use
+    the same words apart from FILLER_WORDS. All entries belong to one corpus
+    version and are dropped when it changes.
+    """
+
+    def __init__(self, max_entries: int = 256, threshold: float = 0.9):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.version = None
+        self._entries = OrderedDict()  # normalised question -> (vector, answer, words)
+        self._matrix = None  # Stacked vectors of _entries, rebuilt lazily
+        self._keys = []
+        self._lock = threading.Lock()
+        self._stats = {"exact_hits": 0, "similar_hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def invalidate(self, version=None):
+        """Drop every cached answer and start a new corpus version."""
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+            self._keys = []
+            self.version = version
+            self._stats["invalidations"] += 1
+
+    def get(self, key: str, vector, version):
+        """Return the answer for the most similar cached question, or None.
+
+        key is the normalised question (used for exact hits and to compare
+        words) and vector its normalised sparse vector; answers from another
+        version never match.
+        """
+        with self._lock:
+            if version != self.version:
+                self._stats["misses"] += 1
+                return None
+
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats["exact_hits"] += 1
+                return entry[1]
+
+            if vector is None or not vector.nnz or not self._entries:
+                self._stats["misses"] += 1
+                return None
+
+            if self._matrix is None:
+                self._keys = list(self._entries)
+                self._matrix = sparse.vstack([self._entries[k][0] for k in self._keys], format='csr')
+
+            words = _question_words(key)
+            candidates = [i for i, k in enumerate(self._keys) if self._entries[k][2] == words]
+            if not candidates:
+                self._stats["misses"] += 1
+                return None
+
+            similarities = (self._matrix[candidates] @ vector.T).toarray().ravel()
+            best = int(similarities.argmax())
+            if similarities[best] < self.threshold:
+                self._stats["misses"] += 1
+                return None
+
+            best_key = self._keys[candidates[best]]
+            self._entries.move_to_end(best_key)
+            self._stats["similar_hits"] += 1
+            return self._entries[best_key][1]
+
+    def set(self, key: str, vector, answer, version):
+        """Cache an answer for a question of the given corpus version."""
+        with self._lock:
+            if version != self.version:
+                return
+            self._entries[key] = (vector, answer, _question_words(key))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+            self._matrix = None
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and the current number of entries."""
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries)}
+
+
+def _question_words(key: str) -> frozenset:
+    """Words of a normalised question that a similar question must share."""
+    return frozenset(key.split()) - FILLER_WORDS
@@ -6,218 +6,770 @@ with web scraping capabilities for additional information.
 
 import os
 import re
+import sys
+import json
 import time
+import argparse
+import itertools
+import contextlib
+import threading
 import requests
 import urllib.parse
-from bs4 import BeautifulSoup
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from collections import Counter
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from requests.adapters import HTTPAdapter
+from scipy import sparse
 import numpy as np
 
+from cache import SemanticAnswerCache, TTLCache
+from chunk_store import ChunkStore, open_or_build_store as open_or_build_chunk_store, open_store as open_chunk_store
+from context_packer import ContextPacker, answer_tokens
+from metrics import propagate, record_ollama_tokens, span
+from ollama_client import OllamaPool, OllamaUnavailableError
+from scheduler import OllamaBusyError, RequestScheduler
+from dense_index import DenseIndex, build_dense_index
+from html_extract import FEED_BYTES, MainTextExtractor, charset_from_content_type
+from index_store import load_index, save_index
+from ingest import corpus_signature, iter_corpus_chunks, iter_documents, html_to_text, HTML_EXTENSIONS
+
 # Configuration
 KNOWLEDGE_FILE = 'knowledge.txt'
-OLLAMA_URL = "http://localhost:11434/api/generate"
+KNOWLEDGE_DIR = None  # Set to a directory of .txt/.md/.html documents to use instead of KNOWLEDGE_FILE
+INGEST_WORKERS = None  # Worker processes for chunking a large corpus (None = one per CPU)
+CHUNK_TOKENS = 60  # Words per knowledge chunk (chunks are cut at sentence boundaries)
+CHUNK_OVERLAP_TOKENS = 10  # Words of trailing sentences repeated at the start of the next chunk
+INDEX_DIR = '.kb_index'  # Where the TF-IDF index is persisted between runs
+CHUNK_STORE_SUBDIR = 'chunks'  # Memory-mapped chunk text under INDEX_DIR, shared by worker processes
+CORPUS_POLL_INTERVAL = 2.0  # Seconds between corpus change checks by the watcher thread
+CORPUS_SETTLE_TIME = 1.0  # Seconds a changed corpus must stay unchanged before it is reloaded
+FAST_START = True  # Serve at once and load the index and model in the background (False: load before serving)
+STARTUP_RETRY_AFTER = 5  # Seconds clients are told to wait while the index is still loading
+OLLAMA_BACKENDS = ["http://localhost:11434"]  # Ollama servers to spread generations across
+OLLAMA_KEEP_ALIVE = "30m"  # How long Ollama keeps the model (and its prompt cache) loaded between requests
+OLLAMA_NUM_CTX = 8192  # Context window requested from Ollama; prompts are packed to fit it
+OLLAMA_TIMEOUT_BASE = 30  # Seconds allowed for a generation before counting its tokens
+OLLAMA_PROMPT_SECONDS_PER_TOKEN = 0.01  # Extra timeout per prompt token
+OLLAMA_SECONDS_PER_TOKEN = 0.25  # Extra timeout per generated token
+TOKENIZER_PATH = None  # tokenizer.json matching OLLAMA_MODEL for exact token counts (needs the tokenizers package)
+OLLAMA_MAX_IN_FLIGHT = 2  # Generations allowed to run at once on each Ollama backend
+OLLAMA_MAX_QUEUE = 16  # Requests allowed to wait for a slot before new ones are rejected (HTTP 429)
+OLLAMA_QUEUE_DEADLINE = 30  # Seconds a request may wait for a slot before giving up (HTTP 503)
+BATCH_CONCURRENCY = 2  # Ollama generations (and web lookups) a batch runs at once
+BATCH_MAX_QUESTIONS = 1000  # Largest batch accepted by /ask/batch
+BATCH_BUSY_RETRIES = 5  # Times a batch generation waits out a saturated scheduler before failing
 KNOWLEDGE_CONFIDENCE_THRESHOLD = 0.3  # If confidence is below this, use web search
+WEB_SPECULATION_DELAY = 0.1  # Seconds a speculative 'both' search waits for the knowledge score before starting
 UNKNOWN_RESPONSE = "I don't know."
 ENABLE_WEB_SCRAPING = True  # Set to False to disable web scraping
+SEARCH_URL = "https://duckduckgo.com/html/"  # DuckDuckGo HTML endpoint queried with ?q=
+WEB_FETCH_DEADLINE = 8.0  # Seconds to wait for scraped pages before using whatever has arrived
+WEB_MAX_PAGE_BYTES = 2 * 1024 * 1024  # Download cap per scraped page
+WEB_PAGE_TEXT_CHARS = 2000  # Main-content characters kept per page (downloading stops once reached)
+WEB_FETCH_WORKERS = 8  # Pages fetched concurrently (also the connection pool size)
+PER_HOST_CONCURRENCY = 2  # Max simultaneous requests to any one host
+PER_HOST_INTERVAL = 1.0  # Min seconds between request starts to the same host
+PER_HOST_MAX_TRACKED = 256  # Hosts whose limits are kept; idle ones are forgotten beyond this
+WEB_CACHE_TTL = 3600  # Seconds cached search results and page text stay valid
+WEB_CACHE_MAX_ENTRIES = 512  # In-memory entries per cache (search results, pages)
+WEB_CACHE_DIR = None  # Set to a directory (e.g. '.web_cache') to keep a disk tier across restarts
+WEB_CACHE_MAX_DISK_BYTES = 50 * 1024 * 1024  # Size bound for each cache's disk tier
+ANSWER_CACHE_MAX_ENTRIES = 256  # Knowledge-mode answers remembered for repeated questions
+ANSWER_CACHE_SIMILARITY = 0.9  # TF-IDF cosine similarity needed to reuse a cached answer
+KNOWLEDGE_TOP_K = 5  # Number of retrieved chunks considered for a knowledge prompt
+PROMPT_TOKEN_BUDGET = 1500  # Max tokens of knowledge context per prompt (less if the window is tighter)
+WEB_TOKEN_BUDGET = 800  # Max tokens of web snippets per prompt, shared across the scraped pages
+DENSE_RETRIEVAL = True  # Fuse TF-IDF matches with latent semantic (dense) matches
+DENSE_MIN_SIMILARITY = 0.3  # Dense matches below this cosine similarity are ignored
+RRF_K = 60  # Reciprocal rank fusion constant (higher flattens rank differences)
+RRF_CANDIDATES = 50  # Candidates taken from each retriever before fusion
 
 # Model configuration - always use Llama 3 8B
 OLLAMA_MODEL = "llama3:8b"
 
-# Global variable to track if knowledge base has been fed to Llama
-_KB_TRAINED_IN_LLAMA = False
+# Sent as the first message of every request. Keeping it byte-identical lets
+# Ollama reuse the evaluated prefix from its KV cache instead of re-reading it.
+SYSTEM_PROMPT = "You are a helpful assistant. Use only the provided context to answer questions. If the information is not in the context, say: I don't know."
 
-# Global variables for TF-IDF
-_VECTORIZER = None
-_TFIDF_MATRIX = None
-_CACHED_CHUNKS = []
-_TRAINED = False
-_KB_MTIME = None
+KNOWLEDGE_PROMPT = """Here is the relevant information from the knowledge base for this question:
 
-def feed_knowledge_to_llama():
-    """Feed the entire knowledge base to Llama on startup to train it for query responses."""
-    global _KB_TRAINED_IN_LLAMA
-    
-    if _KB_TRAINED_IN_LLAMA:
-        print("[Knowledge already fed to Llama]")
-        return True
-    
-    knowledge_content = get_knowledge()
-    if not knowledge_content or len(knowledge_content.strip()) < 10:
-        print("[Warning: No knowledge base content to feed to Llama]")
-        return False
-    
-    print("[Feeding knowledge base to Llama for training...]")
-    
-    # Create a training prompt that teaches Llama about the knowledge base
-    training_prompt = f"""You are an AI assistant with access to a knowledge base. Please read and learn this information so you can answer questions about it accurately.
+{context}
 
-KNOWLEDGE BASE CONTENT:
-{knowledge_content.strip()}
+Question: {question}
+
+Answer based on the knowledge above:"""
 
-Please acknowledge that you have read and understood this information. You will use this knowledge to answer future questions."""
+WEB_PROMPT = """Answer this question using the web sources provided below:
 
-    print(f"[Sending {len(knowledge_content)} characters to Llama for training...]")
-    result = _make_ollama_request(training_prompt, temperature=0.1, num_predict=50, timeout=180)
+{context}
+
+Question: {question}
+
+Based on the web sources above, provide a helpful answer:"""
+
+HYBRID_PROMPT = """Here is the relevant information from the knowledge base and the web for this question:
+
+KNOWLEDGE BASE:
+{knowledge}
+
+WEB SOURCES:
+{web}
+
+Question: {question}
+
+Answer based on the information above, preferring the knowledge base where they disagree:"""
+
+# Global variable to track if the model has been loaded and warmed up
+_LLAMA_WARMED_UP = False
+_STARTUP = {"index": "pending", "model": "pending"}  # Each moves to "loading", then "ready" or "failed"
+_STARTUP_THREADS = []
+_OLLAMA_STATS = {"requests": 0, "prompt_eval_count": 0, "prompt_eval_ms": 0.0, "eval_count": 0, "eval_ms": 0.0}
+_OLLAMA_STATS_LOCK = threading.Lock()
+_OLLAMA_POOL = OllamaPool(OLLAMA_BACKENDS)
+_OLLAMA_SCHEDULER = RequestScheduler(OLLAMA_MAX_IN_FLIGHT * len(OLLAMA_BACKENDS), OLLAMA_MAX_QUEUE,
+                                     OLLAMA_QUEUE_DEADLINE)
+
+# Current KnowledgeIndex snapshot (None until first built). It is replaced as a
+# whole, never modified, so readers need no lock.
+_INDEX = None
+_SNAPSHOT_IDS = itertools.count(1)  # Numbers every index snapshot built by this process
+_REBUILD_LOCK = threading.Lock()  # Serialises index builds
+_REBUILD_THREAD = None
+_REBUILD_THREAD_LOCK = threading.Lock()
+_WATCHER_THREAD = None
+_WATCHER_STOP = threading.Event()
+
+# Shared HTTP state for web search and scraping
+_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+_HTTP_SESSION = requests.Session()
+_HTTP_SESSION.headers['User-Agent'] = _USER_AGENT
+_HTTP_SESSION.mount('http://', HTTPAdapter(pool_connections=WEB_FETCH_WORKERS, pool_maxsize=WEB_FETCH_WORKERS))
+_HTTP_SESSION.mount('https://', HTTPAdapter(pool_connections=WEB_FETCH_WORKERS, pool_maxsize=WEB_FETCH_WORKERS))
+_WEB_EXECUTOR = ThreadPoolExecutor(max_workers=WEB_FETCH_WORKERS, thread_name_prefix='web-fetch')
+# Runs whole speculative lookups for 'both' mode; kept apart from _WEB_EXECUTOR, whose page fetches they wait on
+_SPECULATIVE_EXECUTOR = ThreadPoolExecutor(max_workers=WEB_FETCH_WORKERS, thread_name_prefix='web-speculative')
+_HOST_LIMITERS = {}
+_HOST_LIMITERS_LOCK = threading.Lock()  # Guards _HOST_LIMITERS and each limiter's users count
+_SEARCH_CACHE = TTLCache('search', WEB_CACHE_TTL, WEB_CACHE_MAX_ENTRIES, WEB_CACHE_DIR, WEB_CACHE_MAX_DISK_BYTES)
+_PAGE_CACHE = TTLCache('pages', WEB_CACHE_TTL, WEB_CACHE_MAX_ENTRIES, WEB_CACHE_DIR, WEB_CACHE_MAX_DISK_BYTES)
+_ANSWER_CACHE = SemanticAnswerCache(ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_SIMILARITY)
+_PACKER = ContextPacker(OLLAMA_MODEL, OLLAMA_NUM_CTX, TOKENIZER_PATH)
+
+def warm_up_llama():
+    """Load the model and evaluate the system prompt once so later requests reuse it."""
+    global _LLAMA_WARMED_UP
+    
+    if _LLAMA_WARMED_UP:
+        print("[Llama already warmed up]")
+        return True
+    
+    print("[Loading Llama and caching the system prompt...]")
+    result = _make_ollama_request("Reply with OK.", temperature=0.1, num_predict=1, timeout=180)
     
     if "error" in result:
-        print(f"[Error feeding knowledge to Llama: {result['error']}]")
+        print(f"[Error warming up Llama: {result['error']}]")
         return False
     
-    acknowledgment = result.get('response', '').strip()
-    print(f"[Llama response: {acknowledgment[:100]}...]")
-    _KB_TRAINED_IN_LLAMA = True
-    print("[✓ Knowledge base successfully fed to Llama]")
+    _LLAMA_WARMED_UP = True
+    print(f"[✓ Llama loaded and kept alive for {OLLAMA_KEEP_ALIVE}]")
     return True
 
-def _make_ollama_request(prompt: str, temperature: float = 0.5, num_predict: int = 200, timeout: int = 120) -> dict:
-    """Make a request to Ollama and return the result."""
-    payload = {
+def _build_chat_payload(prompt: str, temperature: float, num_predict: int, stream: bool) -> dict:
+    """Build an /api/chat request with the shared system prompt as its fixed prefix."""
+    return {
         "model": OLLAMA_MODEL,
-        "prompt": prompt,
-        "stream": False,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        "stream": stream,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
         "options": {
             "temperature": temperature,
-            "num_predict": num_predict
+            "num_predict": num_predict,
+            "num_ctx": OLLAMA_NUM_CTX
         }
     }
+
+def _record_ollama_timings(result: dict):
+    """Accumulate prompt/generation token counts and durations from a final Ollama reply."""
+    prompt_ms = result.get("prompt_eval_duration", 0) / 1e6
+    eval_ms = result.get("eval_duration", 0) / 1e6
+    with _OLLAMA_STATS_LOCK:
+        _OLLAMA_STATS["requests"] += 1
+        _OLLAMA_STATS["prompt_eval_count"] += result.get("prompt_eval_count", 0)
+        _OLLAMA_STATS["prompt_eval_ms"] += prompt_ms
+        _OLLAMA_STATS["eval_count"] += result.get("eval_count", 0)
+        _OLLAMA_STATS["eval_ms"] += eval_ms
+    record_ollama_tokens(result.get("prompt_eval_count", 0), result.get("eval_count", 0))
+    print(f"[Ollama: prompt eval {result.get('prompt_eval_count', 0)} tokens in {prompt_ms:.0f} ms, "
+          f"generated {result.get('eval_count', 0)} tokens in {eval_ms:.0f} ms]")
+
+def get_ollama_stats() -> dict:
+    """Return average prompt-evaluation and generation figures per Ollama request."""
+    with _OLLAMA_STATS_LOCK:
+        stats = dict(_OLLAMA_STATS)
+    requests_made = stats["requests"] or 1
+    return {
+        **stats,
+        "avg_prompt_eval_tokens": stats["prompt_eval_count"] / requests_made,
+        "avg_prompt_eval_ms": stats["prompt_eval_ms"] / requests_made,
+        "avg_eval_ms": stats["eval_ms"] / requests_made,
+        "backends": _OLLAMA_POOL.stats()
+    }
+
+def get_ollama_pool() -> OllamaPool:
+    """Return the pool of Ollama backends that generations are routed through."""
+    return _OLLAMA_POOL
+
+def set_ollama_backends(urls: list):
+    """Route generations to a new list of Ollama backends, scaling the in-flight limit to match."""
+    global OLLAMA_BACKENDS, _OLLAMA_POOL
+    OLLAMA_BACKENDS = list(urls)
+    _OLLAMA_POOL = OllamaPool(OLLAMA_BACKENDS)
+    # The ASGI server shares this scheduler, so its limit follows too
+    _OLLAMA_SCHEDULER.resize(OLLAMA_MAX_IN_FLIGHT * len(OLLAMA_BACKENDS))
+
+def get_scheduler_stats() -> dict:
+    """Return queue depth, wait-time and rejection metrics for the Ollama scheduler."""
+    return _OLLAMA_SCHEDULER.stats()
+
+def check_ollama_capacity():
+    """Raise OllamaBusyError right away if the Ollama queue is already full."""
+    _OLLAMA_SCHEDULER.check_capacity()
+
+def _make_ollama_request(prompt: str, temperature: float = 0.5, num_predict: int = 200, timeout: int = 120) -> dict:
+    """Make a request to Ollama and return the result, with the reply text under 'response'.
+    
+    Waits for a scheduler slot first and raises OllamaBusyError if none frees up in time.
+    """
+    payload = _build_chat_payload(prompt, temperature, num_predict, stream=False)
+    
+    with _OLLAMA_SCHEDULER.slot(), span("ollama"):
+        try:
+            with _OLLAMA_POOL.request('/api/chat', payload, timeout) as response:
+                response.raise_for_status()
+                result = response.json()
+        except (requests.exceptions.RequestException, OllamaUnavailableError) as e:
+            return {"error": str(e)}
+        result["response"] = result.get("message", {}).get("content", "")
+        _record_ollama_timings(result)
+        return result
+
+def _stream_ollama_request(prompt: str, temperature: float = 0.5, num_predict: int = 200, timeout: int = 120):
+    """Stream a generation from Ollama, yielding each NDJSON chunk as a dict.
+    
+    Each chunk carries its piece of the reply under 'response'. On failure a
+    single {"error": ...} dict is yielded and the stream ends. The scheduler
+    slot is held until the stream finishes or is closed.
+    """
+    payload = _build_chat_payload(prompt, temperature, num_predict, stream=True)
     
+    with _OLLAMA_SCHEDULER.slot(), span("ollama"):
+        yield from _read_ollama_stream(payload, timeout)
+
+def _read_ollama_stream(payload: dict, timeout: int):
+    """Post a streaming chat request and yield its parsed NDJSON chunks."""
     try:
-        response = requests.post(OLLAMA_URL, json=payload, timeout=timeout)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        return {"error": str(e)}
+        # The timeout bounds the wait for each chunk, not the whole generation
+        with _OLLAMA_POOL.request('/api/chat', payload, timeout, stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if "error" in chunk:
+                    yield {"error": chunk["error"]}
+                    return
+                chunk["response"] = chunk.get("message", {}).get("content", "")
+                yield chunk
+                if chunk.get("done"):
+                    _record_ollama_timings(chunk)
+                    return
+    except (requests.exceptions.RequestException, OllamaUnavailableError, ValueError) as e:
+        yield {"error": str(e)}
+
+def _knowledge_path() -> str:
+    """Return the corpus location: KNOWLEDGE_DIR if configured, else KNOWLEDGE_FILE."""
+    return KNOWLEDGE_DIR or KNOWLEDGE_FILE
 
 def get_knowledge():
     """Load and return the knowledge base content."""
+    path = _knowledge_path()
     try:
-        if os.path.exists(KNOWLEDGE_FILE):
-            with open(KNOWLEDGE_FILE, 'r', encoding='utf-8') as f:
-                return f.read()
-        else:
-            print(f"[Warning: {KNOWLEDGE_FILE} not found]")
+        if not os.path.exists(path):
+            print(f"[Warning: {path} not found]")
             return ""
+        
+        documents = []
+        for doc in iter_documents(path):
+            with open(doc, 'r', encoding='utf-8', errors='replace') as f:
+                content = f.read()
+            documents.append(html_to_text(content) if doc.lower().endswith(HTML_EXTENSIONS) else content)
+        return "\n\n".join(documents)
     except Exception as e:
         print(f"[Error reading knowledge file: {e}]")
         return ""
 
-def _chunk_text(text: str, chunk_size: int = 300, overlap: int = 50) -> list:
-    """Split text into overlapping chunks for TF-IDF processing."""
-    if not text.strip():
-        return []
+@dataclass(frozen=True)
+class KnowledgeIndex:
+    """Immutable snapshot of the knowledge chunks and their TF-IDF and dense indexes.
     
-    # Split into sentences (basic approach)
-    sentences = re.split(r'[.!?]+', text)
-    chunks = []
-    current_chunk = ""
+    A request reads the current snapshot once and uses it throughout, so a
+    rebuild that swaps in a new snapshot never changes data under a running
+    query. The chunk store is read-only and is replaced, never modified.
+    """
+    chunks: ChunkStore = field(default_factory=list)  # Chunk texts (decoded on access), documents and hashes
+    signature: object = None  # corpus_signature() of the corpus the snapshot was built from
+    corpus_tokens: int = 0
+    vectorizer: object = None
+    matrix: object = None
+    postings: object = None  # Inverted index: the TF-IDF matrix transposed to one row per term
+    generation: int = 0  # Persisted index generation; changes whenever the index does
+    dense: DenseIndex = None  # Chunk embeddings, None if dense retrieval is off or the corpus is tiny
+    # Versions the answer cache; unlike generation it never repeats, even when the persisted index is lost
+    snapshot: int = field(default_factory=lambda: next(_SNAPSHOT_IDS))
     
-    for sentence in sentences:
-        sentence = sentence.strip()
-        if not sentence:
-            continue
-            
-        if len(current_chunk) + len(sentence) > chunk_size:
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-                # Keep overlap
-                words = current_chunk.split()
-                if len(words) > overlap // 5:  # Rough word-based overlap
-                    current_chunk = " ".join(words[-(overlap // 5):]) + " " + sentence
-                else:
-                    current_chunk = sentence
-            else:
-                current_chunk = sentence
-        else:
-            current_chunk += " " + sentence if current_chunk else sentence
+    @property
+    def trained(self) -> bool:
+        return self.vectorizer is not None and bool(self.chunks)
+
+def _load_chunks(path: str, signature: tuple) -> ChunkStore:
+    """Map the stored chunks for this version of the corpus, chunking it into a new store if there are none.
     
-    if current_chunk.strip():
-        chunks.append(current_chunk.strip())
+    Worker processes serving the same corpus map the same store, so its
+    pages are shared between them. When several start at once, one builds
+    the store and the others wait for it.
+    """
+    store_dir = os.path.join(INDEX_DIR, CHUNK_STORE_SUBDIR)
+    key = {"path": os.path.abspath(path), "signature": signature,
+           "chunk_tokens": CHUNK_TOKENS, "overlap_tokens": CHUNK_OVERLAP_TOKENS}
+    store = open_chunk_store(store_dir, key)
+    if store is not None:
+        print(f"[Mapped {len(store)} stored chunks]")
+        return store
     
-    return chunks
+    print("[Reloading knowledge chunks...]")
+    chunks = iter_corpus_chunks(path, CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS, workers=INGEST_WORKERS)
+    store = open_or_build_chunk_store(store_dir, key, chunks, _estimate_tokens)
+    print(f"[Loaded {len(store)} chunks ({store.text_bytes / (1024 * 1024):.1f} MB of text)]")
+    return store
 
-def _ensure_chunks_loaded():
-    """Ensure the knowledge chunks are loaded and current."""
-    global _CACHED_CHUNKS, _KB_MTIME
+def _count_terms(chunks, analyzer, vocabulary: dict):
+    """Count analyzed terms per chunk, adding unseen terms to the vocabulary.
     
-    if not os.path.exists(KNOWLEDGE_FILE):
-        _CACHED_CHUNKS = []
-        _KB_MTIME = None
-        return
+    chunks may be a generator, so each chunk can be dropped once it is counted.
+    """
+    indptr = [0]
+    indices = []
+    values = []
+    for chunk in chunks:
+        for term, count in Counter(analyzer(chunk)).items():
+            indices.append(vocabulary.setdefault(term, len(vocabulary)))
+            values.append(count)
+        indptr.append(len(indices))
     
-    current_mtime = os.path.getmtime(KNOWLEDGE_FILE)
+    return sparse.csr_matrix(
+        (np.array(values, dtype=np.int32), np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int32)),
+        shape=(len(indptr) - 1, len(vocabulary))
+    )
+
+def _update_index(chunks: ChunkStore, hashes: list, stored, analyzer) -> tuple:
+    """Build term counts for the current chunks, re-vectorizing only unseen ones.
+    
+    Rows for chunks whose content hash is already in the stored index are
+    reused as-is; IDF weights are then recomputed from the combined counts.
+    """
+    known_rows = {}
+    vocabulary = {}
+    old_counts = sparse.csr_matrix((0, 0), dtype=np.int32)
+    if stored:
+        known_rows = {h: row for row, h in enumerate(stored["chunk_hashes"])}
+        vocabulary = dict(stored["vocabulary"])
+        old_counts = stored["counts"]
+    
+    new_positions = [i for i, h in enumerate(hashes) if h not in known_rows]
+    # Chunks are decoded from the store one at a time rather than all at once
+    new_counts = _count_terms((chunks[i] for i in new_positions), analyzer, vocabulary)
+    print(f"[Vectorized {len(new_positions)} new or changed chunks, reused {len(hashes) - len(new_positions)}]")
+    
+    # Stack old and new rows at the new vocabulary width, then put them in chunk order
+    n_terms = len(vocabulary)
+    old_counts = sparse.csr_matrix(
+        (old_counts.data, old_counts.indices, old_counts.indptr), shape=(old_counts.shape[0], n_terms)
+    )
+    new_row = {pos: old_counts.shape[0] + k for k, pos in enumerate(new_positions)}
+    order = [known_rows[h] if h in known_rows else new_row[i] for i, h in enumerate(hashes)]
+    counts = sparse.vstack([old_counts, new_counts], format='csr')[order]
     
-    if _KB_MTIME != current_mtime:
-        print("[Reloading knowledge chunks...]")
-        knowledge = get_knowledge()
-        _CACHED_CHUNKS = _chunk_text(knowledge)
-        _KB_MTIME = current_mtime
-        print(f"[Loaded {len(_CACHED_CHUNKS)} chunks]")
+    # Drop terms that only appeared in chunks that no longer exist
+    df = np.bincount(counts.indices, minlength=n_terms)
+    keep = df > 0
+    if not keep.all():
+        new_columns = np.cumsum(keep) - 1
+        counts = counts[:, keep]
+        vocabulary = {term: int(new_columns[col]) for term, col in vocabulary.items() if keep[col]}
+        df = df[keep]
+    
+    from sklearn.preprocessing import normalize
+    
+    # Same smoothed IDF and L2 normalisation as TfidfVectorizer's defaults
+    idf = np.log((1 + counts.shape[0]) / (1 + df)) + 1
+    tfidf = normalize(counts.multiply(idf).tocsr().astype(np.float64))
+    return vocabulary, idf, counts, tfidf
 
-def _train_index():
-    """Train or retrain the TF-IDF index on the chunks."""
-    global _VECTORIZER, _TFIDF_MATRIX, _TRAINED
+def _build_index(previous: KnowledgeIndex) -> KnowledgeIndex:
+    """Build a snapshot for the current corpus, reusing what it can from previous.
     
-    _ensure_chunks_loaded()
+    The persisted TF-IDF index is loaded as-is when the chunks are unchanged,
+    and otherwise updated by re-vectorizing only new or changed chunks.
+    """
+    path = _knowledge_path()
+    signature = corpus_signature(path)
+    if signature is None:
+        print(f"[Warning: {path} not found]")
+        return KnowledgeIndex()
+    if signature == previous.signature:
+        return previous
     
-    if not _CACHED_CHUNKS:
+    chunks = _load_chunks(path, signature)
+    if previous.trained and corpus_signature(path) != signature:
+        # Half-written files are never served; the watcher retries once writes settle
+        print("[Knowledge changed while loading, keeping the current index]")
+        return previous
+    if not chunks:
         print("[No chunks available for training]")
-        _VECTORIZER = None
-        _TFIDF_MATRIX = None
-        _TRAINED = False
-        return
+        return KnowledgeIndex(signature=signature)
+    
+    # scikit-learn is imported on first use so the server can start before it has loaded
+    from sklearn.feature_extraction.text import TfidfVectorizer
     
-    print("[Training TF-IDF index...]")
-    _VECTORIZER = TfidfVectorizer(
+    # The vocabulary is left uncapped so it can grow as chunks are added
+    vectorizer = TfidfVectorizer(
         stop_words='english',
-        max_features=1000,
-        ngram_range=(1, 2),
-        min_df=1
+        ngram_range=(1, 2)
     )
     
+    hashes = chunks.hashes()
+    stored = load_index(INDEX_DIR)
+    
+    if stored and stored["chunk_hashes"] == hashes and (stored["dense"] is not None or not DENSE_RETRIEVAL):
+        vocabulary, idf, tfidf = stored["vocabulary"], stored["idf"], stored["tfidf"]
+        postings = stored["postings"] if stored["postings"] is not None else tfidf.T.tocsr()
+        generation = stored["generation"]
+        dense = DenseIndex(**stored["dense"]) if DENSE_RETRIEVAL and stored["dense"] else None
+        print(f"[Loaded persisted TF-IDF index for {len(hashes)} chunks]")
+    else:
+        print("[Training TF-IDF index...]")
+        if stored and stored["chunk_hashes"] == hashes:
+            vocabulary, idf, counts, tfidf = stored["vocabulary"], stored["idf"], stored["counts"], stored["tfidf"]
+        else:
+            vocabulary, idf, counts, tfidf = _update_index(chunks, hashes, stored, vectorizer.build_analyzer())
+        # The projection depends on the whole corpus, so embeddings are refitted on every change.
+        # Dense arrays are saved as None while dense retrieval is off, so turning it on later builds
+        # them, and as {} when it is on but the corpus is too small for them
+        dense = build_dense_index(tfidf) if DENSE_RETRIEVAL else None
+        postings = tfidf.T.tocsr()
+        generation = save_index(INDEX_DIR, hashes, vocabulary, idf, counts, tfidf,
+                                previous_generation=stored["generation"] if stored else 0,
+                                dense=dense.arrays() if dense else ({} if DENSE_RETRIEVAL else None),
+                                postings=postings)
+        print(f"[TF-IDF index trained on {len(chunks)} chunks]")
+    
+    vectorizer.vocabulary_ = vocabulary
+    vectorizer.idf_ = np.asarray(idf)
+    return KnowledgeIndex(chunks, signature, chunks.tokens, vectorizer, tfidf, postings, generation, dense)
+
+def _install_index(index: KnowledgeIndex):
+    """Atomically make index the snapshot used by new requests."""
+    global _INDEX
+    _INDEX = index
+    
+    # Cached answers (and their question vectors) belong to the previous index
+    if _ANSWER_CACHE.version != index.snapshot:
+        _ANSWER_CACHE.invalidate(index.snapshot)
+
+def _train_index():
+    """Build the index for the current corpus and swap it in (blocking the caller)."""
+    with _REBUILD_LOCK:
+        try:
+            index = _build_index(_INDEX or KnowledgeIndex())
+        except Exception as e:
+            print(f"[Error training TF-IDF: {e}]")
+            if _INDEX is None:
+                _install_index(KnowledgeIndex())
+            return
+        _install_index(index)
+
+def _schedule_rebuild():
+    """Rebuild the index on a background thread unless a rebuild is already running."""
+    global _REBUILD_THREAD
+    with _REBUILD_THREAD_LOCK:
+        if _REBUILD_THREAD is not None and _REBUILD_THREAD.is_alive():
+            return
+        _REBUILD_THREAD = threading.Thread(target=_train_index, name='kb-rebuild', daemon=True)
+        _REBUILD_THREAD.start()
+
+def _current_index() -> KnowledgeIndex:
+    """Return the current index snapshot, building the first one if needed."""
+    if _INDEX is None:
+        _train_index()
+    return _INDEX
+
+def _watch_corpus():
+    """Poll the corpus and rebuild the index once a change has settled (watcher thread body)."""
+    seen = _INDEX.signature if _INDEX is not None else None
+    changed_at = time.monotonic()
+    while not _WATCHER_STOP.wait(CORPUS_POLL_INTERVAL):
+        try:
+            signature = corpus_signature(_knowledge_path())
+        except OSError:
+            continue  # A document vanished mid-scan; look again next time
+        
+        now = time.monotonic()
+        if signature != seen:
+            seen, changed_at = signature, now  # Still being written; wait for it to settle
+            continue
+        
+        current = _INDEX.signature if _INDEX is not None else None
+        if signature is not None and signature != current and now - changed_at >= CORPUS_SETTLE_TIME:
+            print("[Knowledge file changed, rebuilding index...]")
+            _train_index()
+
+def start_corpus_watcher():
+    """Start the thread that reloads the corpus when it changes, so requests never stat it."""
+    global _WATCHER_THREAD
+    if _WATCHER_THREAD is not None and _WATCHER_THREAD.is_alive():
+        return
+    _WATCHER_STOP.clear()
+    _WATCHER_THREAD = threading.Thread(target=_watch_corpus, name='kb-watcher', daemon=True)
+    _WATCHER_THREAD.start()
+
+def stop_corpus_watcher():
+    """Stop the corpus watcher thread."""
+    _WATCHER_STOP.set()
+
+def _load_index_at_startup():
+    _STARTUP["index"] = "loading"
+    _train_index()
+    # Corpus edits are picked up by the watcher instead of a check on every request
+    start_corpus_watcher()
+    _STARTUP["index"] = "ready"
+
+def _warm_up_model_at_startup():
+    _STARTUP["model"] = "loading"
     try:
-        _TFIDF_MATRIX = _VECTORIZER.fit_transform(_CACHED_CHUNKS)
-        _TRAINED = True
-        print(f"[TF-IDF index trained on {len(_CACHED_CHUNKS)} chunks]")
-    except Exception as e:
-        print(f"[Error training TF-IDF: {e}]")
-        _TRAINED = False
+        _STARTUP["model"] = "ready" if warm_up_llama() else "failed"
+    except OllamaBusyError:
+        _STARTUP["model"] = "failed"
+
+def start_warm_up(background: bool = None):
+    """Load the index and warm up the model on separate threads.
+    
+    In fast-start mode (the default) this returns at once, so the server can
+    bind and answer health checks while scikit-learn, the index and the model
+    load; is_ready() turns True once the index is in place. Otherwise it
+    waits for both to finish.
+    """
+    if not _STARTUP_THREADS:
+        for name, target in (('kb-startup', _load_index_at_startup), ('llm-warm-up', _warm_up_model_at_startup)):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            _STARTUP_THREADS.append(thread)
+    
+    if not (FAST_START if background is None else background):
+        for thread in _STARTUP_THREADS:
+            thread.join()
+
+def is_ready() -> bool:
+    """Whether questions can be answered, i.e. an index (possibly empty) has been loaded."""
+    return _INDEX is not None
+
+def get_startup_status() -> dict:
+    """Return liveness, readiness and the progress of the index load and model warm-up."""
+    return {"live": True, "ready": is_ready(), **_STARTUP}
 
 def _refresh_if_changed():
-    """Check if the knowledge file has changed and refresh if needed."""
-    global _TRAINED, _KB_MTIME
+    """Make sure an index exists and, without a watcher, refresh it if the corpus changed.
     
-    if not os.path.exists(KNOWLEDGE_FILE):
+    With the corpus watcher running this never touches the filesystem. In-flight
+    and new requests keep using the current snapshot until a rebuilt one is
+    swapped in.
+    """
+    if _INDEX is None:
+        _train_index()
+        return
+    if _WATCHER_THREAD is not None and _WATCHER_THREAD.is_alive():
         return
     
-    current_mtime = os.path.getmtime(KNOWLEDGE_FILE)
-    if _KB_MTIME != current_mtime:
-        print("[Knowledge file changed, refreshing...]")
-        _TRAINED = False
-        _ensure_chunks_loaded()
-        _train_index()
+    with span("refresh_check"):
+        current_signature = corpus_signature(_knowledge_path())
+    if current_signature is None:
+        return
+    
+    if current_signature != _INDEX.signature:
+        print("[Knowledge file changed, refreshing in the background...]")
+        _schedule_rebuild()
 
-def retrieve_relevant(query: str, top_k: int = 5) -> list:
-    """Retrieve the most relevant chunks for a query using TF-IDF."""
-    if not _TRAINED:
-        _train_index()
+def get_index_status() -> dict:
+    """Return the size and generation of the current index and whether a rebuild is running."""
+    index = _INDEX or KnowledgeIndex()
+    return {
+        "chunks": len(index.chunks),
+        "generation": index.generation,
+        "rebuilding": _REBUILD_THREAD is not None and _REBUILD_THREAD.is_alive(),
+        "watching": _WATCHER_THREAD is not None and _WATCHER_THREAD.is_alive()
+    }
+
+def _fuse_rankings(sparse_ranked: list, dense_ranked: list, top_k: int) -> list:
+    """Merge TF-IDF and dense (chunk_id, score) rankings with reciprocal rank fusion.
+    
+    Chunks are ordered by their fused rank, but the score returned for each is
+    its TF-IDF cosine (0 for dense-only matches). Dense cosines run high on a
+    low-dimensional projection, so they only decide the order and never feed
+    the confidence score.
+    """
+    fused = {}
+    for ranking in (sparse_ranked, dense_ranked):
+        for rank, (chunk_id, _) in enumerate(ranking):
+            fused[chunk_id] = fused.get(chunk_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+    
+    sparse_scores = dict(sparse_ranked)
+    order = sorted(fused, key=fused.get, reverse=True)[:top_k]
+    return [(chunk_id, sparse_scores.get(chunk_id, 0.0)) for chunk_id in order]
+
+def _top_k(ids, scores, k: int) -> list:
+    """Return the k highest-scoring (id, score) pairs with a positive score, best first.
+    
+    Only the k winners are sorted; the rest are split off with argpartition.
+    """
+    if len(scores) > k:
+        winners = np.argpartition(-scores, k - 1)[:k]
+        ids, scores = ids[winners], scores[winners]
+    order = np.argsort(-scores)
+    return [(int(ids[i]), float(scores[i])) for i in order if scores[i] > 0]
+
+def _rank_vectors(query_vectors, top_k: int, index: KnowledgeIndex) -> list:
+    """Rank chunks for each row of a TF-IDF query matrix, returning one ranking per row.
     
-    if not _TRAINED or not _CACHED_CHUNKS:
+    TF-IDF scores come from one sparse product with the inverted index, which
+    only touches the postings of terms the queries contain. Those matches are
+    fused with dense (latent semantic) matches, so a chunk that only
+    paraphrases the question can still be retrieved.
+    """
+    candidates = max(top_k, RRF_CANDIDATES)
+    scores = (query_vectors @ index.postings).tocsr()
+    rankings = []
+    for row in range(scores.shape[0]):
+        start, end = scores.indptr[row], scores.indptr[row + 1]
+        sparse_ranked = _top_k(scores.indices[start:end], scores.data[start:end], candidates)
+        if index.dense is None:
+            rankings.append(sparse_ranked[:top_k])
+            continue
+        
+        dense_ranked = [
+            (chunk_id, score) for chunk_id, score in index.dense.search(query_vectors[row], candidates)
+            if score >= DENSE_MIN_SIMILARITY
+        ]
+        rankings.append(_fuse_rankings(sparse_ranked, dense_ranked, top_k))
+    return rankings
+
+def _rank_chunks(query: str, top_k: int = 5, index: KnowledgeIndex = None) -> list:
+    """Rank chunks for a query and return (chunk_id, TF-IDF score) pairs, best first.
+    
+    Chunks found only by dense retrieval have a score of 0.
+    """
+    index = index or _current_index()
+    if not index.trained:
         return []
     
     try:
-        query_vector = _VECTORIZER.transform([query])
-        similarities = cosine_similarity(query_vector, _TFIDF_MATRIX).flatten()
-        
-        # Get top-k most similar chunks
-        top_indices = np.argsort(similarities)[::-1][:top_k]
-        top_chunks = [(similarities[i], _CACHED_CHUNKS[i]) for i in top_indices if similarities[i] > 0]
-        
-        return top_chunks
+        with span("retrieval"):
+            return _rank_vectors(index.vectorizer.transform([query]), top_k, index)[0]
     except Exception as e:
         print(f"[Error in retrieval: {e}]")
         return []
 
+def retrieve_relevant(query: str, top_k: int = 5) -> list:
+    """Retrieve the most relevant chunks for a query using hybrid TF-IDF and dense retrieval."""
+    index = _current_index()
+    return [(score, index.chunks[i]) for i, score in _rank_chunks(query, top_k, index)]
+
+def retrieve_relevant_batch(queries: list, top_k: int = 5) -> list:
+    """Retrieve the most relevant chunks for many queries at once (e.g. for offline evaluation).
+    
+    All queries are vectorized and scored against the inverted index in a
+    single sparse matrix product. Returns one list of (score, chunk) pairs per
+    query, in the same order as queries.
+    """
+    index = _current_index()
+    if not index.trained or not queries:
+        return [[] for _ in queries]
+    
+    with span("retrieval_batch"):
+        rankings = _rank_vectors(index.vectorizer.transform(queries), top_k, index)
+    return [[(score, index.chunks[i]) for i, score in ranking] for ranking in rankings]
+
+def _estimate_tokens(text: str) -> int:
+    """Count how many tokens OLLAMA_MODEL will see for a piece of text (estimated without a tokenizer)."""
+    return _PACKER.count(text)
+
+def _generation_timeout(prompt: str, num_predict: int) -> float:
+    """Scale the Ollama timeout with the prompt it must read and the answer it may write."""
+    return (OLLAMA_TIMEOUT_BASE + _estimate_tokens(prompt) * OLLAMA_PROMPT_SECONDS_PER_TOKEN
+            + num_predict * OLLAMA_SECONDS_PER_TOKEN)
+
+def build_knowledge_prompt(question: str, top_k: int = KNOWLEDGE_TOP_K,
+                           token_budget: int = PROMPT_TOKEN_BUDGET, index: KnowledgeIndex = None,
+                           ranked: list = None) -> dict:
+    """Build a retrieval-augmented prompt from the top-k chunks that fit in the token budget.
+    
+    Returns a dict with the prompt, the retrieved (score, chunk) pairs used for
+    confidence scoring, and the IDs of the chunks that were placed in the prompt.
+    Prompt size is bounded by the budget no matter how large the corpus grows.
+    ranked is an already computed ranking (e.g. from a batch retrieval pass).
+    """
+    index = index or _current_index()
+    if ranked is None:
+        ranked = _rank_chunks(question, top_k, index)
+    with span("prompt_build"):
+        return _pack_knowledge_prompt(question, ranked, token_budget, index)
+
+def _pack_knowledge_prompt(question: str, ranked: list, token_budget: int, index: KnowledgeIndex) -> dict:
+    """Pack ranked chunks into a knowledge prompt (see build_knowledge_prompt)."""
+    candidates = [chunk_id for chunk_id, _ in ranked]
+    
+    # A corpus that fits the budget entirely is sent whole, best matches first
+    if index.chunks and index.corpus_tokens <= token_budget:
+        ranked_ids = set(candidates)
+        candidates += [i for i in range(len(index.chunks)) if i not in ranked_ids]
+    
+    # What is left of the window after the instructions, question and answer caps the budget
+    num_predict = answer_tokens(question)
+    fixed = SYSTEM_PROMPT + KNOWLEDGE_PROMPT.format(context="", question=question)
+    token_budget = _PACKER.budget(fixed, num_predict, cap=token_budget)
+    chosen, used_tokens = _PACKER.pack([index.chunks[i] for i in candidates], token_budget)
+    chunk_ids = [candidates[i] for i in chosen]
+    
+    context = "\n\n".join(index.chunks[i] for i in chunk_ids)
+    return {
+        "prompt": KNOWLEDGE_PROMPT.format(context=context, question=question),
+        "context": context,
+        "top_chunks": [(score, index.chunks[i]) for i, score in ranked],
+        "chunk_ids": chunk_ids,
+        "context_tokens": used_tokens,
+        "num_predict": num_predict
+    }
+
+def _knowledge_sources(chunk_ids: list, index: KnowledgeIndex) -> list:
+    """Name the knowledge documents the given chunks came from."""
+    if not KNOWLEDGE_DIR:
+        return ["Knowledge base"]
+    
+    docs = dict.fromkeys(os.path.relpath(index.chunks.doc(i), KNOWLEDGE_DIR) for i in chunk_ids)
+    return [f"Knowledge base: {doc}" for doc in docs]
+
+@span("confidence")
 def _calculate_knowledge_confidence(question: str, chunks: list) -> float:
     """Calculate confidence based on chunk similarity and keyword matching."""
     if not chunks:
@@ -243,64 +795,180 @@ def _calculate_knowledge_confidence(question: str, chunks: list) -> float:
     
     return min(confidence, 1.0)
 
+class _HostLimiter:
+    """Politeness limit for one host: bounded concurrency and spacing between request starts."""
+    
+    def __init__(self):
+        self._slots = threading.Semaphore(PER_HOST_CONCURRENCY)
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+        self.users = 0  # Requests holding or waiting for the limiter
+    
+    def idle(self, now: float) -> bool:
+        """Whether forgetting the limiter cannot let a request start early."""
+        return not self.users and now >= self._next_start
+    
+    def __enter__(self):
+        self._slots.acquire()
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + PER_HOST_INTERVAL
+        time.sleep(start - now)
+        return self
+    
+    def __exit__(self, *exc_info):
+        self._slots.release()
+
+def _forget_idle_hosts(limiters: dict):
+    """Drop the limiters of hosts with no request running or due, so the table stays bounded."""
+    now = time.monotonic()
+    for host in [host for host, limiter in limiters.items() if limiter.idle(now)]:
+        del limiters[host]
+
+def _http_get(url: str, timeout: float = 10, stream: bool = False):
+    """GET a URL through the pooled session, respecting the per-host limits.
+    
+    With stream=True the body is left unread; close the response when done.
+    """
+    host = urllib.parse.urlparse(url).netloc
+    with _HOST_LIMITERS_LOCK:
+        limiter = _HOST_LIMITERS.get(host)
+        if limiter is None:
+            if len(_HOST_LIMITERS) >= PER_HOST_MAX_TRACKED:
+                _forget_idle_hosts(_HOST_LIMITERS)
+            limiter = _HOST_LIMITERS[host] = _HostLimiter()
+        limiter.users += 1
+    
+    try:
+        with limiter:
+            response = _HTTP_SESSION.get(url, timeout=timeout, stream=stream)
+    finally:
+        with _HOST_LIMITERS_LOCK:
+            limiter.users -= 1
+    if not response.ok:
+        response.close()
+    response.raise_for_status()
+    return response
+
+def _normalize_query(query: str) -> str:
+    """Normalise a query for cache lookups (case, punctuation and spacing)."""
+    return " ".join(re.findall(r'\w+', query.lower()))
+
+@span("web_search")
 def _search_web(query: str, num_results: int = 3) -> list:
+    """Search for URLs using DuckDuckGo, serving repeated queries from the cache."""
+    cache_key = f"{num_results}:{_normalize_query(query)}"
+    urls = _SEARCH_CACHE.get(cache_key)
+    if urls is not None:
+        print("[Search results served from cache]")
+        return urls
+    
+    urls = _fetch_search_results(query, num_results)
+    if urls:  # Failed or empty searches are retried next time
+        _SEARCH_CACHE.set(cache_key, urls)
+    return urls
+
+def _fetch_search_results(query: str, num_results: int = 3) -> list:
     """Search for URLs using DuckDuckGo."""
     try:
         # Use DuckDuckGo for search
         search_query = urllib.parse.quote_plus(query)
-        search_url = f"https://duckduckgo.com/html/?q={search_query}"
+        search_url = f"{SEARCH_URL}?q={search_query}"
         
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        
-        response = requests.get(search_url, headers=headers, timeout=10)
-        response.raise_for_status()
-        
-        soup = BeautifulSoup(response.content, 'html.parser')
-        urls = []
-        
-        # Find search result links
-        for link in soup.find_all('a', {'class': 'result__a'}):
-            href = link.get('href')
-            if href and href.startswith('http'):
-                urls.append(href)
-                if len(urls) >= num_results:
-                    break
-        
-        return urls[:num_results]
+        response = _http_get(search_url, timeout=10)
+        return _parse_search_results(response.content, num_results)
     except Exception as e:
         print(f"[Error searching web: {e}]")
         return []
 
-def _scrape_webpage(url: str) -> str:
-    """Scrape and clean text content from a webpage."""
+def _parse_search_results(html: bytes, num_results: int) -> list:
+    """Extract result URLs from a DuckDuckGo HTML results page."""
+    from bs4 import BeautifulSoup
+    
+    soup = BeautifulSoup(html, 'html.parser')
+    urls = []
+    
+    # Find search result links
+    for link in soup.find_all('a', {'class': 'result__a'}):
+        href = link.get('href')
+        if href and href.startswith('http'):
+            urls.append(href)
+            if len(urls) >= num_results:
+                break
+    
+    return urls[:num_results]
+
+def _scrape_webpage(url: str, timeout: float = 10) -> str:
+    """Scrape and clean text content from a webpage, using the page cache when possible."""
+    content = _PAGE_CACHE.get(url)
+    if content is not None:
+        return content
+    return _fetch_webpage(url, timeout)
+
+@span("scrape")
+def _fetch_webpage(url: str, timeout: float = 10) -> str:
+    """Download, clean and cache the text content of a webpage."""
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        # Remove script and style elements
-        for script in soup(["script", "style", "nav", "header", "footer", "aside"]):
-            script.decompose()
-        
-        # Get text and clean it
-        text = soup.get_text()
-        lines = (line.strip() for line in text.splitlines())
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        text = ' '.join(chunk for chunk in chunks if chunk)
-        
-        # Limit text length
-        return text[:2000] if text else ""
+        with _http_get(url, timeout=timeout, stream=True) as response:
+            text = _read_page_text(response.iter_content(FEED_BYTES), response.headers.get('Content-Type'), url)
+        if text:
+            _PAGE_CACHE.set(url, text)
+        return text
     except Exception as e:
         print(f"[Error scraping {url}: {e}]")
         return ""
 
+def _read_page_text(chunks, content_type: str, url: str) -> str:
+    """Extract a page's main text from its body chunks as they arrive.
+    
+    Reading stops once WEB_PAGE_TEXT_CHARS of content text have been found or
+    WEB_MAX_PAGE_BYTES have been downloaded, whichever comes first.
+    """
+    extractor = MainTextExtractor(WEB_PAGE_TEXT_CHARS, charset_from_content_type(content_type))
+    received = 0
+    for chunk in chunks:
+        received += len(chunk)
+        if extractor.feed(chunk):
+            break
+        if received >= WEB_MAX_PAGE_BYTES:
+            print(f"[Stopped reading {url} at {received // 1024} KB]")
+            break
+    return extractor.text()
+
+def _scrape_webpages(urls: list, deadline: float = None, cancel: threading.Event = None) -> list:
+    """Scrape several pages concurrently and return (url, content) pairs in search order.
+    
+    Cached pages are used without touching the network. Pages that have not
+    arrived when the deadline (seconds from now) expires are left out; their
+    fetches finish in the background and still populate the cache. Once
+    cancel is set no further pages are requested.
+    """
+    deadline = WEB_FETCH_DEADLINE if deadline is None else deadline
+    pages = {url: _PAGE_CACHE.get(url) for url in urls}
+    
+    futures = {}
+    for url in urls:
+        if cancel is not None and cancel.is_set():
+            print("[Web lookup cancelled]")
+            return []
+        if pages[url] is None:
+            print(f"[Scraping: {urllib.parse.urlparse(url).netloc}]")
+            futures[url] = _WEB_EXECUTOR.submit(propagate(_fetch_webpage), url, min(10, deadline))
+    
+    if futures:
+        done, not_done = wait(futures.values(), timeout=deadline)
+        if not_done:
+            print(f"[Web fetch deadline reached, skipping {len(not_done)} slow page(s)]")
+        for url, future in futures.items():
+            pages[url] = future.result() if future in done else None
+    
+    return [(url, pages[url]) for url in urls if pages[url]]
+
+def get_web_cache_stats() -> dict:
+    """Return hit/miss statistics for the search-result and page caches."""
+    return {"search": _SEARCH_CACHE.stats(), "pages": _PAGE_CACHE.stats()}
+
 def _get_web_context(question: str) -> str:
     """Get relevant context from web scraping."""
     if not ENABLE_WEB_SCRAPING:
@@ -316,20 +984,23 @@ def _get_web_context(question: str) -> str:
         return ""
     
     # Scrape content from URLs
-    web_content = []
-    for url in urls:
-        print(f"[Scraping: {urllib.parse.urlparse(url).netloc}]")
-        content = _scrape_webpage(url)
-        if content:
-            web_content.append(f"Source: {url}\nContent: {content[:800]}")  # Limit per source
-        time.sleep(1)  # Be respectful to servers
+    web_content = [f"Source: {url}\nContent: {content[:800]}" for url, content in _scrape_webpages(urls)]  # Limit per source
     
     return "\n\n".join(web_content) if web_content else ""
 
-def _get_web_context_with_sources(question: str) -> tuple:
-    """Get relevant context from web scraping and return both content and source URLs."""
+def _fetch_web_pages(question: str, cancel: threading.Event = None) -> list:
+    """Search the web for a question and scrape the top results into (url, text) pairs.
+    
+    With cancel, the search waits up to WEB_SPECULATION_DELAY for it to be
+    set and is skipped if it is, so a speculative lookup that is not needed
+    usually sends nothing. Once cancel is set no further pages are requested;
+    a search already under way finishes and its results are cached.
+    """
     if not ENABLE_WEB_SCRAPING:
-        return "", []
+        return []
+    if cancel is not None and cancel.wait(WEB_SPECULATION_DELAY):
+        print("[Web lookup cancelled]")
+        return []
     
     print("[Searching web for additional context...]")
     
@@ -338,202 +1009,438 @@ def _get_web_context_with_sources(question: str) -> tuple:
     
     if not urls:
         print("[No web results found or no internet connection]")
-        return "", []
-    
-    # Scrape content from URLs
-    web_content = []
-    source_urls = []
-    for url in urls:
-        print(f"[Scraping: {urllib.parse.urlparse(url).netloc}]")
-        content = _scrape_webpage(url)
-        if content:
-            web_content.append(f"Source: {url}\nContent: {content[:600]}")  # Reduced from 1200 to 600 chars
-            source_urls.append(url)
-        time.sleep(1)  # Be respectful to servers
+        return []
     
-    return "\n\n".join(web_content) if web_content else "", source_urls
+    return _scrape_webpages(urls, cancel=cancel)
 
+def _get_web_context_with_sources(question: str) -> tuple:
+    """Get relevant context from web scraping and return both content and source URLs."""
+    return _pack_web_context(question, _fetch_web_pages(question))
 
-def ask_question_web(question: str, source_type: str = 'knowledge') -> dict:
-    """Enhanced ask_question with web context support and source type control."""
+def _pack_web_context(question: str, pages: list, reserved_tokens: int = 0) -> tuple:
+    """Fit scraped (url, text) pages into the web prompt's token budget.
     
-    # For knowledge-only mode, use the simple working approach
-    if source_type == 'knowledge' or source_type not in ['knowledge', 'web']:
-        # Check if knowledge base exists
-        kb_content = get_knowledge()
-        if not kb_content or len(kb_content.strip()) < 10:
-            return {
-                "answer": "I don't know.",
-                "sources": ["Knowledge base (empty)"],
-                "web_sources": [],
-                "confidence": 0.0
-            }
-        
-        # Use the EXACT same approach as the working ask_question function
-        full_context = kb_content.strip()
-        
-        # Use knowledge base content with reminder of training
-        prompt = f"""You have been trained with knowledge base information. Here is the relevant information for this question:
+    Near-duplicate pages are dropped and the budget is shared between the
+    rest, so one long page cannot crowd out the others. reserved_tokens are
+    already taken by other context in the same prompt. Returns the context
+    and the URLs that made it in.
+    """
+    if not pages:
+        return "", []
+    
+    headers = [f"Source: {url}\nContent: " for url, _ in pages]
+    fixed = SYSTEM_PROMPT + WEB_PROMPT.format(context="", question=question)
+    budget = _PACKER.budget(fixed, answer_tokens(question) + reserved_tokens, cap=WEB_TOKEN_BUDGET)
+    budget -= sum(_estimate_tokens(header) for header in headers)
+    
+    packed = _PACKER.pack_fair([text for _, text in pages], budget)
+    context = "\n\n".join(headers[i] + text for i, text in packed)
+    return context, [pages[i][0] for i, _ in packed]
 
-{full_context}
 
-Question: {question}
+def _error_result(message: str) -> dict:
+    """Build the response returned when Ollama could not be reached."""
+    return {
+        "answer": f"Error: Could not connect to Ollama. Is it running? ({message})",
+        "sources": [],
+        "web_sources": [],
+        "confidence": 0.0
+    }
 
-Answer based on the knowledge above:"""
+def _assess_knowledge(question: str, index: KnowledgeIndex, ranked: list = None) -> tuple:
+    """Build the knowledge prompt for a question and score it, returning (built, confidence)."""
+    built = build_knowledge_prompt(question, index=index, ranked=ranked)
+    confidence = _calculate_knowledge_confidence(question, built["top_chunks"]) if built["chunk_ids"] else 0.0
+    return built, confidence
 
-        result = _make_ollama_request(prompt, temperature=0.5, num_predict=150)
-        
-        if "error" in result:
-            return {
-                "answer": f"Error: Could not connect to Ollama. Is it running? ({result['error']})",
-                "sources": [],
-                "web_sources": [],
-                "confidence": 0.0
-            }
-        
-        answer = result.get('response', '').strip()
-        
-        # Filter out generic responses
-        generic_phrases = [
+def _no_knowledge_result(index: KnowledgeIndex) -> dict:
+    return {"result": {
+        "answer": UNKNOWN_RESPONSE,
+        "sources": ["Knowledge base (no relevant content)"] if index.chunks else ["Knowledge base (empty)"],
+        "web_sources": [],
+        "confidence": 0.0,
+        "chunk_ids": []
+    }}
+
+def _knowledge_plan(question: str, built: dict, confidence: float, index: KnowledgeIndex) -> dict:
+    """Plan an answer from the knowledge base alone."""
+    if not built["chunk_ids"]:
+        return _no_knowledge_result(index)
+    
+    print(f"[Using {len(built['chunk_ids'])} chunks (~{built['context_tokens']} tokens), confidence: {confidence:.2f}]")
+    return {
+        "prompt": built["prompt"],
+        "num_predict": built["num_predict"],
+        "timeout": _generation_timeout(built["prompt"], built["num_predict"]),
+        "generic_phrases": [
             "i understand", "i'm ready", "okay, i understand", 
             "let's start", "i will use", "based on the provided",
             "i can help", "let me help", "ready to help"
-        ]
-        
-        if not answer or any(phrase in answer.lower()[:50] for phrase in generic_phrases):
-            answer = "I don't know."
-        
-        return {
-            "answer": answer + "\n\n(Answer based on knowledge base only)",
-            "sources": ["Knowledge base"],
+        ],
+        "lenient_filter": False,
+        "source_info": "\n\n(Answer based on knowledge base only)",
+        "metadata": {
+            "sources": _knowledge_sources(built["chunk_ids"], index),
             "web_sources": [],
-            "confidence": 1.0
+            "confidence": confidence,
+            "chunk_ids": built["chunk_ids"]
         }
+    }
+
+def _web_plan(question: str, prompt: str, source_info: str, metadata: dict) -> dict:
+    """Plan an answer whose prompt includes web sources."""
+    num_predict = answer_tokens(question)
+    return {
+        "prompt": prompt,
+        "num_predict": num_predict,
+        "timeout": _generation_timeout(prompt, num_predict),
+        "generic_phrases": ["i understand", "i'm ready", "okay, i understand", "let's start", "ready to help"],
+        # For web content, only filter if it's clearly generic AND short
+        "lenient_filter": True,
+        "source_info": source_info,
+        "metadata": metadata
+    }
+
+def _hybrid_plan(question: str, built: dict, confidence: float, pages: list, index: KnowledgeIndex) -> dict:
+    """Plan a 'both' answer from the knowledge context and scraped (url, text) pages.
     
-    # For web-only and both modes, use the complex logic
-    context_block = ""
-    web_context = ""
-    web_sources = []
-    knowledge_confidence = 0.0
-    
-    # Handle source type preferences
-    use_knowledge = source_type == 'knowledge'
-    use_web = source_type == 'web'
-    
-    # Get knowledge base context if requested
-    if use_knowledge:
-        kb_content = get_knowledge()
-        if kb_content and len(kb_content.strip()) >= 10:
-            top_chunks = retrieve_relevant(question)
-            knowledge_confidence = _calculate_knowledge_confidence(question, top_chunks)
-            context_block = kb_content.strip()
-            print(f"[Knowledge Base Confidence: {knowledge_confidence:.2f}]")
-    
-    # Get web context for web and both modes
-    if use_web:
-        try:
-            print("[Web-only mode requested]")
-            web_context, web_sources = _get_web_context_with_sources(question)
-            if web_context:
-                print(f"[Web content retrieved: {len(web_context)} chars from {len(web_sources)} sources]")
-                print(f"[First 200 chars: {web_context[:200]}...]")
-            else:
-                print("[No web content retrieved]")
-        except Exception as e:
-            print(f"[Web scraping failed: {e}]")
-            web_context = ""
-            web_sources = []
-    elif use_web and source_type == 'both' and knowledge_confidence < KNOWLEDGE_CONFIDENCE_THRESHOLD:
+    The web snippets get whatever the knowledge context left of the window.
+    Either side may be empty, in which case the other is used alone.
+    """
+    web_context, web_sources = _pack_web_context(question, pages, reserved_tokens=built["context_tokens"])
+    if not web_context:
+        print("[No web content retrieved, answering from the knowledge base]")
+        return _knowledge_plan(question, built, confidence, index)
+    
+    with span("prompt_build"):
+        if built["chunk_ids"]:
+            prompt = HYBRID_PROMPT.format(knowledge=built["context"], web=web_context, question=question)
+        else:
+            prompt = WEB_PROMPT.format(context=web_context, question=question)
+    print(f"[Combining {len(built['chunk_ids'])} chunks with {len(web_sources)} web sources]")
+    return _web_plan(question, prompt, "\n\n(Answer based on knowledge base and web sources)", {
+        "sources": _knowledge_sources(built["chunk_ids"], index) if built["chunk_ids"] else [],
+        "web_sources": web_sources,
+        "confidence": confidence,
+        "chunk_ids": built["chunk_ids"]
+    })
+
+def _plan_answer(question: str, source_type: str, index: KnowledgeIndex, web: tuple = None,
+                 ranked: list = None) -> dict:
+    """Gather context for a question and build the prompt and response metadata.
+    
+    Returns either {"result": ...} when the question can be answered without
+    calling Ollama, or a plan holding the prompt, generation options and the
+    metadata that goes with the final answer. web is an already fetched
+    (context, sources) pair; when it is None, web mode fetches it here.
+    ranked is an already computed knowledge ranking for the question.
+    
+    In 'both' mode the web search starts speculatively while the knowledge
+    base is scored. If the knowledge confidence clears
+    KNOWLEDGE_CONFIDENCE_THRESHOLD the web work is cancelled and the answer
+    uses the knowledge base alone; otherwise both contexts are combined.
+    """
+    if source_type == 'both':
+        cancel = threading.Event()
+        speculative = _SPECULATIVE_EXECUTOR.submit(propagate(_fetch_web_pages), question, cancel)
+        built, confidence = _assess_knowledge(question, index, ranked)
+        if confidence >= KNOWLEDGE_CONFIDENCE_THRESHOLD:
+            cancel.set()
+            speculative.cancel()
+            print(f"[Knowledge Base Confidence: {confidence:.2f}, skipping the web]")
+            return _knowledge_plan(question, built, confidence, index)
+        
+        print(f"[Knowledge Base Confidence ({confidence:.2f}) below threshold, waiting for the web]")
         try:
-            print(f"[Knowledge base confidence ({knowledge_confidence:.2f}) below threshold]")
-            web_context, web_sources = _get_web_context_with_sources(question)
+            pages = speculative.result()
         except Exception as e:
             print(f"[Web scraping failed: {e}]")
-            web_context = ""
-            web_sources = []
-    
-    # Build context and response
-    actual_sources_used = []
-    actual_web_sources_used = []
-    
-    if source_type == 'web':
-        if web_context:
-            full_context = f"WEB SOURCES:\n{web_context}"
-            source_info = "\n\n(Answer based on current web sources only)"
-            actual_web_sources_used = web_sources
-        else:
-            # Always fallback to KB if web fails
-            if context_block.strip():
-                print("[Web sources unavailable or no internet, replying from knowledge base]")
-                full_context = context_block
-                source_info = "\n\n(Answer based on knowledge base only)"
-                actual_sources_used = ["Knowledge base (web fallback)"]
-            else:
-                return {
-                    "answer": "I don't know.",
-                    "sources": [],
-                    "web_sources": [],
-                    "confidence": 0.0
-                }
-    # Remove 'both' mode entirely
-    
-    if not full_context.strip():
-        return {
+            pages = []
+        return _hybrid_plan(question, built, confidence, pages, index)
+    
+    if source_type != 'web':
+        # Only the retrieved chunks that fit the token budget go into the prompt
+        built, confidence = _assess_knowledge(question, index, ranked)
+        return _knowledge_plan(question, built, confidence, index)
+    
+    try:
+        print("[Web-only mode requested]")
+        web_context, web_sources = web if web is not None else _get_web_context_with_sources(question)
+    except Exception as e:
+        print(f"[Web scraping failed: {e}]")
+        web_context, web_sources = "", []
+    
+    if not web_context.strip():
+        print("[No web content retrieved]")
+        return {"result": {
             "answer": "I don't know.",
             "sources": [],
             "web_sources": [],
             "confidence": 0.0
-        }
+        }}
+    
+    print(f"[Web content retrieved: {len(web_context)} chars from {len(web_sources)} sources]")
+    print(f"[First 200 chars: {web_context[:200]}...]")
+    with span("prompt_build"):
+        prompt = WEB_PROMPT.format(context=web_context, question=question)
+    return _web_plan(question, prompt, "\n\n(Answer based on current web sources only)", {
+        "sources": [],
+        "web_sources": web_sources,
+        "confidence": 0.0
+    })
 
-    # Use different prompts for different content types
-    if source_type == 'web':
-        prompt = f"""Answer this question using the web sources provided below:
+def _finalize_answer(raw_answer: str, plan: dict) -> dict:
+    """Filter generic model replies and attach the plan's source metadata."""
+    answer = raw_answer.strip()
+    generic_phrases = plan["generic_phrases"]
+    
+    # Filter out generic responses
+    if plan["lenient_filter"]:
+        if not answer or (len(answer) < 20 and any(phrase in answer.lower() for phrase in generic_phrases)):
+            answer = "I don't know."
+    else:
+        if not answer or any(phrase in answer.lower()[:50] for phrase in generic_phrases):
+            answer = "I don't know."
+    
+    return {"answer": answer + plan["source_info"], **plan["metadata"]}
 
-{full_context}
+def _lookup_answer_cache(question: str, source_type: str, index: KnowledgeIndex, vector=None) -> tuple:
+    """Look up a cached knowledge-mode answer for the question.
+    
+    Returns (result, key, vector); result is None on a miss and key is None when
+    the question is not cacheable (web answers depend on live pages). vector is
+    the question's TF-IDF row if it has already been computed.
+    """
+    if source_type != 'knowledge' or not index.trained:
+        return None, None, None
+    
+    key = _normalize_query(question)
+    if vector is None:
+        vector = index.vectorizer.transform([question])
+    result = _ANSWER_CACHE.get(key, vector, index.snapshot)
+    if result is not None:
+        print("[Answer served from cache]")
+        result = {**result, "cached": True}
+    return result, key, vector
 
-Question: {question}
+def get_answer_cache_stats() -> dict:
+    """Return hit/miss statistics for the semantic answer cache."""
+    return _ANSWER_CACHE.stats()
 
-Based on the web sources above, provide a helpful answer:"""
-    else:
-        prompt = f"""You have been trained with knowledge base information. Here is the relevant information for this question:
+def ask_question_web(question: str, source_type: str = 'knowledge') -> dict:
+    """Enhanced ask_question with web context support and source type control."""
+    index = _current_index()
+    cached, cache_key, question_vector = _lookup_answer_cache(question, source_type, index)
+    if cached is not None:
+        return cached
+    
+    plan = _plan_answer(question, source_type, index)
+    if "result" in plan:
+        return plan["result"]
+    
+    result = _make_ollama_request(plan["prompt"], temperature=0.5,
+                                  num_predict=plan["num_predict"], timeout=plan["timeout"])
+    
+    if "error" in result:
+        return _error_result(result["error"])
+    
+    answer = _finalize_answer(result.get('response', ''), plan)
+    if cache_key is not None:
+        _ANSWER_CACHE.set(cache_key, question_vector, answer, index.snapshot)
+    return answer
 
-{full_context}
+def ask_question_stream(question: str, source_type: str = 'knowledge'):
+    """Answer a question while streaming the model output as it is generated.
+    
+    Yields (event, data) pairs: ("token", {"text": ...}) for each piece of the
+    answer, then a single ("done", result) carrying the same fields as
+    ask_question_web, or ("error", result) if Ollama failed.
+    """
+    index = _current_index()
+    cached, cache_key, question_vector = _lookup_answer_cache(question, source_type, index)
+    if cached is not None:
+        yield "done", cached
+        return
+    
+    plan = _plan_answer(question, source_type, index)
+    if "result" in plan:
+        yield "done", plan["result"]
+        return
+    
+    pieces = []
+    for chunk in _stream_ollama_request(plan["prompt"], temperature=0.5,
+                                        num_predict=plan["num_predict"], timeout=plan["timeout"]):
+        if "error" in chunk:
+            yield "error", _error_result(chunk["error"])
+            return
+        
+        text = chunk.get('response', '')
+        if text:
+            pieces.append(text)
+            yield "token", {"text": text}
+    
+    answer = _finalize_answer("".join(pieces), plan)
+    if cache_key is not None:
+        _ANSWER_CACHE.set(cache_key, question_vector, answer, index.snapshot)
+    yield "done", answer
 
-Question: {question}
+def parse_batch_lines(lines, default_source: str = 'knowledge') -> list:
+    """Parse JSONL batch input into question items.
+    
+    Each line is a JSON object with a "question" (and optionally "sourceType"
+    and "id") or a bare JSON string. Blank lines are skipped; a line that
+    cannot be used becomes an item carrying an "error".
+    """
+    items = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            items.append({"question": "", "error": f"Line {number} is not valid JSON: {e}"})
+            continue
+        
+        if isinstance(data, str):
+            data = {"question": data}
+        if not isinstance(data, dict):
+            items.append({"question": "", "error": f"Line {number} is not a question"})
+            continue
+        
+        question = data.get('question')
+        item = {"question": question.strip() if isinstance(question, str) else "",
+                "source_type": data.get('sourceType', default_source)}
+        if data.get('id') is not None:
+            item["id"] = data['id']
+        if item["source_type"] not in ['knowledge', 'web', 'both']:
+            item["source_type"] = 'knowledge'
+        if not item["question"]:
+            item["error"] = f"Line {number} has no question"
+        items.append(item)
+    return items
 
-Answer based on the knowledge above:"""
+def _generate_batch_answer(plan: dict) -> dict:
+    """Run one batch generation, waiting out a saturated scheduler rather than failing at once."""
+    for attempt in range(BATCH_BUSY_RETRIES + 1):
+        try:
+            return _make_ollama_request(plan["prompt"], temperature=0.5,
+                                        num_predict=plan["num_predict"], timeout=plan["timeout"])
+        except OllamaBusyError as e:
+            if attempt == BATCH_BUSY_RETRIES:
+                return {"error": str(e)}
+            time.sleep(e.retry_after)
 
-    result = _make_ollama_request(prompt, temperature=0.5, num_predict=200, timeout=60)
+def answer_batch(items: list, concurrency: int = BATCH_CONCURRENCY):
+    """Answer a batch of question items, yielding one result per item as it completes.
     
-    if "error" in result:
-        return {
-            "answer": f"Error: Could not connect to Ollama. Is it running? ({result['error']})",
-            "sources": [],
-            "web_sources": [],
-            "confidence": 0.0
-        }
+    Knowledge questions are vectorized and retrieved in one pass, questions
+    whose prompts come out identical share a single generation, and at most
+    concurrency web lookups or generations run at once. Each result has the
+    fields of ask_question_web (or an "error") plus the item's position in
+    the batch as "index", its question and its "id" if it had one.
+    """
+    index = _current_index()
+    groups = {}  # (prompt, num_predict) -> [(position, plan, cache key, question vector)]
     
-    answer = result.get('response', '').strip()
+    def tagged(position: int, result: dict) -> dict:
+        item = items[position]
+        tag = {"index": position, "question": item["question"]}
+        if "id" in item:
+            tag["id"] = item["id"]
+        return {**tag, **result}
     
-    # Filter out generic responses
-    generic_phrases = ["i understand", "i'm ready", "okay, i understand", "let's start", "ready to help"]
+    for position, item in enumerate(items):
+        if "error" in item:
+            yield tagged(position, {"error": item["error"]})
     
-    # For web content, only filter if it's clearly generic AND short
-    if source_type == 'web':
-        if not answer or (len(answer) < 20 and any(phrase in answer.lower() for phrase in generic_phrases)):
-            answer = "I don't know."
-    else:
-        if not answer or any(phrase in answer.lower()[:50] for phrase in generic_phrases):
-            answer = "I don't know."
+    # Knowledge and 'both' questions share one vectorized retrieval pass
+    retrieving = [p for p, item in enumerate(items) if "error" not in item and item["source_type"] != 'web']
+    vectors = rankings = None
+    if retrieving and index.trained:
+        vectors = index.vectorizer.transform([items[p]["question"] for p in retrieving])
+        with span("retrieval_batch"):
+            rankings = _rank_vectors(vectors, KNOWLEDGE_TOP_K, index)
+    ranked = {p: rankings[row] if rankings is not None else None for row, p in enumerate(retrieving)}
     
-    return {
-        "answer": answer + source_info,
-        "sources": actual_sources_used,
-        "web_sources": actual_web_sources_used,
-        "confidence": knowledge_confidence
-    }
+    for row, position in enumerate(retrieving):
+        if items[position]["source_type"] != 'knowledge':
+            continue
+        question = items[position]["question"]
+        cached, cache_key, vector = _lookup_answer_cache(question, 'knowledge', index,
+                                                         vectors[row] if vectors is not None else None)
+        if cached is not None:
+            yield tagged(position, cached)
+            continue
+        plan = _plan_answer(question, 'knowledge', index, ranked=ranked[position])
+        if "result" in plan:
+            yield tagged(position, plan["result"])
+        else:
+            groups.setdefault((plan["prompt"], plan["num_predict"]), []).append((position, plan, cache_key, vector))
+    
+    pool = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    try:
+        # Web and 'both' questions are planned concurrently, since they may search and scrape
+        web = [p for p, item in enumerate(items) if "error" not in item and item["source_type"] != 'knowledge']
+        planning = {pool.submit(propagate(_plan_answer), items[p]["question"], items[p]["source_type"], index,
+                                ranked=ranked.get(p)): p for p in web}
+        for future in as_completed(planning):
+            position = planning[future]
+            try:
+                plan = future.result()
+            except Exception as e:
+                yield tagged(position, {"error": f"An error occurred: {e}"})
+                continue
+            if "result" in plan:
+                yield tagged(position, plan["result"])
+            else:
+                groups.setdefault((plan["prompt"], plan["num_predict"]), []).append((position, plan, None, None))
+        
+        print(f"[Batch of {len(items)} questions needs {len(groups)} generations]")
+        generating = {pool.submit(propagate(_generate_batch_answer), members[0][1]): members
+                      for members in groups.values()}
+        for future in as_completed(generating):
+            try:
+                reply = future.result()
+            except Exception as e:
+                reply = {"error": str(e)}
+            for position, plan, cache_key, vector in generating[future]:
+                if "error" in reply:
+                    yield tagged(position, _error_result(reply["error"]))
+                    continue
+                answer = _finalize_answer(reply.get('response', ''), plan)
+                if cache_key is not None:
+                    _ANSWER_CACHE.set(cache_key, vector, answer, index.snapshot)
+                yield tagged(position, answer)
+    finally:
+        # A consumer that stops early (e.g. a disconnected client) cancels the generations not yet started
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def main():
+    """Answer a JSONL file of questions from the command line, writing JSONL results."""
+    parser = argparse.ArgumentParser(description="Answer a batch of questions (one JSON object or string per line).")
+    parser.add_argument('questions', help="JSONL file of questions, or - for standard input")
+    parser.add_argument('-o', '--output', help="Write results to this file instead of standard output")
+    parser.add_argument('--source', choices=['knowledge', 'web', 'both'], default='knowledge',
+                        help="Source for questions that do not set sourceType")
+    parser.add_argument('--concurrency', type=int, default=BATCH_CONCURRENCY, help="Generations run at once")
+    args = parser.parse_args()
+    
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    # Progress messages go to stderr so the output holds only results
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.questions == '-':
+            items = parse_batch_lines(sys.stdin, args.source)
+        else:
+            with open(args.questions, 'r', encoding='utf-8') as f:
+                items = parse_batch_lines(f, args.source)
+        _train_index()
+        for result in answer_batch(items, args.concurrency):
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+    if output is not sys.stdout:
+        output.close()
 
 
 if __name__ == "__main__":
-    # This file is imported as a module, not run directly
-    pass
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,232 @@
+"""
+Memory-Mapped Chunk Store
+Keeps the knowledge chunks in a single UTF-8 file with arrays of (offset,
+length, doc id) records, all memory-mapped. A chunk is decoded only when it
+is read, so resident memory per chunk is a few bytes of records rather than
+a Python string, and every worker process that maps the same files shares
+their pages through the OS page cache. Overlapping neighbours are stored
+once: a chunk that starts inside the previous one points back into its text.
+"""
+
+import os
+import json
+import glob
+import mmap
+import time
+import uuid
+from array import array
+import numpy as np
+
+MANIFEST_FILE = 'chunks.json'
+LOCK_FILE = 'build.lock'
+STALE_FILE_AGE = 60  # Seconds before files of a superseded store may be deleted
+LOCK_POLL_INTERVAL = 0.5  # Seconds between checks while another process builds the store
+LOCK_HEARTBEAT = 10  # Seconds between touches of the lock file during a build
+LOCK_STALE_AGE = 120  # A lock untouched this long was left by a build that died and is broken
+
+
+def _text_path(store_dir: str, tag: str) -> str:
+    return os.path.join(store_dir, f"text.{tag}.txt")
+
+
+def _array_path(store_dir: str, name: str, tag: str) -> str:
+    return os.path.join(store_dir, f"{name}.{tag}.npy")
+
+
+class ChunkStore:
+    """Read-only, list-like view of stored chunks; store[i] decodes chunk i."""
+
+    def __init__(self, text, offsets, lengths, doc_ids, doc_offsets, hashes, docs: list, tokens: int):
+        self._text = text
+        self._offsets = offsets
+        self._lengths = lengths
+        self._doc_ids = doc_ids
+        self._doc_offsets = doc_offsets
+        self._hashes = hashes
+        self.docs = docs
+        self.tokens = tokens  # Estimated tokens across all chunks
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __getitem__(self, i: int) -> str:
+        start = int(self._offsets[i])
+        return self._text[start:start + int(self._lengths[i])].decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def doc(self, i: int) -> str:
+        """Path of the document chunk i came from."""
+        return self.docs[int(self._doc_ids[i])]
+
+    def doc_offset(self, i: int) -> int:
+        """Offset of chunk i in its document (bytes for text files, characters of extracted text for HTML)."""
+        return int(self._doc_offsets[i])
+
+    def hashes(self) -> list:
+        """Content hashes of every chunk, in order."""
+        return [h.decode('ascii') for h in self._hashes]
+
+    @property
+    def text_bytes(self) -> int:
+        return len(self._text)
+
+
+def _overlap(previous: tuple, doc: str, offset: int, chunk: str, data: bytes):
+    """Return how many bytes into the previous chunk this one starts, if it only extends it."""
+    prev_doc, prev_offset, prev_chunk, prev_data = previous
+    delta = offset - prev_offset
+    if prev_doc != doc or delta <= 0:
+        return None
+    # Offsets are bytes for text files and characters for HTML; either way the shared text must match
+    if delta < len(prev_data) and data.startswith(prev_data[delta:]):
+        return delta
+    if delta < len(prev_chunk) and chunk.startswith(prev_chunk[delta:]):
+        return len(prev_chunk[:delta].encode('utf-8'))
+    return None
+
+
+def build_store(store_dir: str, key: dict, chunks, count_tokens) -> ChunkStore:
+    """Write the (chunk, metadata) pairs from chunks to a new store and map it.
+
+    Metadata is the {"doc", "offset", "id"} dict produced by ingest. key
+    identifies the corpus and chunking settings; open_store only returns a
+    store whose key matches. Files are written under a name unique to this
+    build and the manifest is replaced last, as in index_store.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    tag = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+    offsets, lengths, doc_ids, doc_offsets = array('q'), array('i'), array('i'), array('q')
+    hashes, doc_index = [], {}
+    tokens, written, previous = 0, 0, None
+
+    with open(_text_path(store_dir, tag), 'wb') as f:
+        for chunk, meta in chunks:
+            data = chunk.encode('utf-8')
+            shared = _overlap(previous, meta["doc"], meta["offset"], chunk, data) if previous else None
+            if shared is None:
+                offsets.append(written)
+                f.write(data)
+                written += len(data)
+            else:
+                # The previous chunk ends at the end of the file, so only the new tail is written
+                offsets.append(offsets[-1] + shared)
+                tail = data[len(previous[3]) - shared:]
+                f.write(tail)
+                written += len(tail)
+            lengths.append(len(data))
+            doc_ids.append(doc_index.setdefault(meta["doc"], len(doc_index)))
+            doc_offsets.append(meta["offset"])
+            hashes.append(meta["id"])
+            tokens += count_tokens(chunk)
+            previous = (meta["doc"], meta["offset"], chunk, data)
+
+    docs = list(doc_index)
+    np.save(_array_path(store_dir, 'offsets', tag), np.frombuffer(offsets, dtype=np.int64))
+    np.save(_array_path(store_dir, 'lengths', tag), np.frombuffer(lengths, dtype=np.int32))
+    np.save(_array_path(store_dir, 'doc_ids', tag), np.frombuffer(doc_ids, dtype=np.int32))
+    np.save(_array_path(store_dir, 'doc_offsets', tag), np.frombuffer(doc_offsets, dtype=np.int64))
+    np.save(_array_path(store_dir, 'hashes', tag), np.array(hashes, dtype='S40'))
+
+    manifest_path = os.path.join(store_dir, MANIFEST_FILE)
+    tmp_path = f"{manifest_path}.{tag}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"tag": tag, "key": key, "docs": docs, "tokens": tokens}, f)
+    os.replace(tmp_path, manifest_path)
+
+    _remove_stale_files(store_dir, tag)
+    return _map_store(store_dir, tag, docs, tokens)
+
+
+def _touching(chunks, lock_path: str):
+    """Pass chunks through, refreshing the lock file's mtime so waiting processes know the build is alive."""
+    touched = time.time()
+    for item in chunks:
+        if time.time() - touched > LOCK_HEARTBEAT:
+            touched = time.time()
+            try:
+                os.utime(lock_path)
+            except OSError:
+                pass
+        yield item
+
+
+def open_or_build_store(store_dir: str, key: dict, chunks, count_tokens) -> ChunkStore:
+    """Map the store for key, building it from chunks if no process has yet.
+
+    Builds are serialised across processes by a lock file, so worker
+    processes that start together chunk the corpus once and all map the
+    same files. chunks is only consumed by the process that builds.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    lock_path = os.path.join(store_dir, LOCK_FILE)
+    while True:
+        store = open_store(store_dir, key)
+        if store is not None:
+            return store
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > LOCK_STALE_AGE:
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                continue  # Released meanwhile
+            time.sleep(LOCK_POLL_INTERVAL)
+            continue
+
+        os.close(fd)
+        try:
+            # Another process may have finished a build between the check above and taking the lock
+            store = open_store(store_dir, key)
+            if store is not None:
+                return store
+            return build_store(store_dir, key, _touching(chunks, lock_path), count_tokens)
+        finally:
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+
+
+def open_store(store_dir: str, key: dict):
+    """Map the persisted store if it was built for key, else return None."""
+    manifest_path = os.path.join(store_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest['key'] != json.loads(json.dumps(key)):
+            return None
+        return _map_store(store_dir, manifest['tag'], manifest['docs'], manifest['tokens'])
+    except Exception as e:
+        print(f"[Error loading chunk store: {e}]")
+        return None
+
+
+def _map_store(store_dir: str, tag: str, docs: list, tokens: int) -> ChunkStore:
+    with open(_text_path(store_dir, tag), 'rb') as f:
+        # mmap cannot map an empty file; the mapping stays valid after the file is closed
+        text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+    arrays = {
+        name: np.load(_array_path(store_dir, name, tag), mmap_mode='r')
+        for name in ('offsets', 'lengths', 'doc_ids', 'doc_offsets', 'hashes')
+    }
+    return ChunkStore(text, docs=docs, tokens=tokens, **arrays)
+
+
+def _remove_stale_files(store_dir: str, tag: str):
+    # Superseded files may still be mapped by another process, so only old ones are removed
+    cutoff = time.time() - STALE_FILE_AGE
+    for path in glob.glob(os.path.join(store_dir, '*.npy')) + glob.glob(os.path.join(store_dir, 'text.*.txt')):
+        if f".{tag}." not in os.path.basename(path):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,165 @@
+"""
+Context Packing
+Counts tokens the way the configured model does and fits prompt context into
+its window. The instructions, the question and the answer length are
+reserved first; the remaining tokens are filled with knowledge chunks or web
+snippets in rank order, skipping passages that repeat ones already packed.
+"""
+
+import re
+from itertools import islice
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:  # Optional: without it token counts are estimated
+    Tokenizer = None
+
+# Estimated tokens per word or punctuation mark, by model family (larger vocabularies split fewer words)
+TOKENS_PER_PIECE = {'llama3': 1.05, 'llama2': 1.25, 'mistral': 1.2, 'gemma': 1.05, 'phi3': 1.2}
+DEFAULT_TOKENS_PER_PIECE = 1.25
+WINDOW_SAFETY_MARGIN = 0.05  # Fraction of the window left free to absorb counting error
+NEAR_DUPLICATE_SIMILARITY = 0.6  # Word-shingle Jaccard similarity at which a passage repeats another
+SHINGLE_WORDS = 3  # Words per shingle when comparing passages
+
+SHORT_ANSWER_TOKENS = 64  # Yes/no questions
+FACT_ANSWER_TOKENS = 128  # Who/when/where/how-many questions
+DEFAULT_ANSWER_TOKENS = 200
+LONG_ANSWER_TOKENS = 384  # Why/how/explain/compare questions
+
+_PIECE = re.compile(r"\w+|[^\w\s]")
+_WORD = re.compile(r"\w+")
+_EXPLAIN = re.compile(r'\b(why|explain|describe|compare|difference|differences|steps|list|summari[sz]e|overview)\b',
+                      re.IGNORECASE)
+_YES_NO = re.compile(r'^(is|are|was|were|do|does|did|can|could|will|would|should|has|have|had)\b', re.IGNORECASE)
+_FACT = re.compile(r'^(who|when|where|which|what year|what time|how (many|much|old|long|far|big|tall|large))\b',
+                   re.IGNORECASE)
+
+
+def answer_tokens(question: str) -> int:
+    """Pick a generation length (num_predict) suited to the kind of question."""
+    question = question.strip()
+    if _EXPLAIN.search(question):
+        return LONG_ANSWER_TOKENS
+    if _YES_NO.match(question):
+        return SHORT_ANSWER_TOKENS
+    if _FACT.match(question):
+        return FACT_ANSWER_TOKENS
+    if question.lower().startswith('how'):
+        return LONG_ANSWER_TOKENS
+    return DEFAULT_ANSWER_TOKENS
+
+
+def _shingles(text: str) -> set:
+    words = _WORD.findall(text.lower())
+    if len(words) <= SHINGLE_WORDS:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def _is_near_duplicate(shingles: set, kept: list) -> bool:
+    for other in kept:
+        union = len(shingles | other)
+        if union and len(shingles & other) / union >= NEAR_DUPLICATE_SIMILARITY:
+            return True
+    return False
+
+
+class ContextPacker:
+    """Token counting and context-window budgeting for one model.
+
+    With a tokenizer.json for the model (and the tokenizers package) counts
+    are exact; otherwise they are estimated from the word and punctuation
+    count, scaled for the model family.
+    """
+
+    def __init__(self, model: str, context_window: int, tokenizer_path: str = None):
+        self.model = model
+        self.context_window = context_window
+        self._tokenizer = None
+        if tokenizer_path and Tokenizer is not None:
+            self._tokenizer = Tokenizer.from_file(tokenizer_path)
+        elif tokenizer_path:
+            print("[tokenizers is not installed, estimating token counts]")
+        family = model.lower().split(':')[0]
+        self._tokens_per_piece = next(
+            (ratio for name, ratio in TOKENS_PER_PIECE.items() if family.startswith(name)), DEFAULT_TOKENS_PER_PIECE
+        )
+
+    @property
+    def exact(self) -> bool:
+        return self._tokenizer is not None
+
+    def count(self, text: str) -> int:
+        """Count (or estimate) the tokens the model will see for text."""
+        if self._tokenizer is not None:
+            return len(self._tokenizer.encode(text, add_special_tokens=False).ids)
+        return int(len(_PIECE.findall(text)) * self._tokens_per_piece + 0.5)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Cut text to at most max_tokens tokens, ending on a token boundary."""
+        if max_tokens <= 0:
+            return ""
+        if self._tokenizer is not None:
+            offsets = self._tokenizer.encode(text, add_special_tokens=False).offsets
+            return text if len(offsets) <= max_tokens else text[:offsets[max_tokens - 1][1]]
+
+        if self.count(text) <= max_tokens:
+            return text
+        pieces = int(max_tokens / self._tokens_per_piece)
+        last = next(islice(_PIECE.finditer(text), pieces - 1, None), None) if pieces else None
+        return text[:last.end()] if last else ""
+
+    def budget(self, fixed_text: str, answer_tokens: int, cap: int = None) -> int:
+        """Tokens left for context once fixed_text (instructions and question) and the answer are reserved."""
+        usable = int(self.context_window * (1 - WINDOW_SAFETY_MARGIN))
+        available = max(0, usable - self.count(fixed_text) - answer_tokens)
+        return available if cap is None else min(cap, available)
+
+    def pack(self, passages: list, budget: int) -> tuple:
+        """Choose passages in order while they fit the budget, skipping near duplicates.
+
+        Returns (indices of the chosen passages, tokens used). A passage too
+        large for what is left is skipped so a shorter, lower-ranked one can
+        still fit.
+        """
+        chosen, kept, used = [], [], 0
+        for i, text in enumerate(passages):
+            tokens = self.count(text)
+            if used + tokens > budget:
+                continue
+            shingles = _shingles(text)
+            if _is_near_duplicate(shingles, kept):
+                continue
+            chosen.append(i)
+            kept.append(shingles)
+            used += tokens
+        return chosen, used
+
+    def pack_fair(self, passages: list, budget: int) -> list:
+        """Share the budget across passages, truncating the long ones to their share.
+
+        Near duplicates are dropped first. Short passages keep their full
+        length and leave what they do not use to the others. Returns
+        (index, text) pairs in the original order.
+        """
+        unique, kept = [], []
+        for i, text in enumerate(passages):
+            shingles = _shingles(text)
+            if text.strip() and not _is_near_duplicate(shingles, kept):
+                unique.append((i, self.count(text)))
+                kept.append(shingles)
+
+        allowed = {}
+        remaining = budget
+        by_length = sorted(unique, key=lambda item: item[1])
+        for n, (i, tokens) in enumerate(by_length):
+            share = remaining // (len(by_length) - n)
+            allowed[i] = min(tokens, share)
+            remaining -= allowed[i]
+
+        packed = []
+        for i, tokens in unique:
+            text = passages[i] if allowed[i] >= tokens else self.truncate(passages[i], allowed[i])
+            if text:
+                packed.append((i, text))
+        return packed
@@ -0,0 +1,128 @@
+"""
+Dense Retrieval Index
+Latent semantic embeddings of the knowledge chunks (a truncated SVD of their
+TF-IDF rows), searched exhaustively on small corpora and through an
+inverted-file index of k-means clusters on large ones. A question that
+paraphrases a chunk lands near it even when they share few exact terms.
+"""
+
+import numpy as np
+from dataclasses import dataclass
+
+DENSE_DIM = 128  # Embedding dimensions
+DENSE_MIN_DIM = 32  # Smaller corpora get no dense index: a few dimensions put every question near some chunk
+DENSE_MAX_TERMS = 200000  # Most widespread terms kept for the projection (bounds its size)
+SVD_SAMPLE_ROWS = 50000  # Chunks sampled to fit the projection
+IVF_MIN_CHUNKS = 50000  # Below this, search scans every embedding
+IVF_PROBES = 8  # Clusters scanned per query
+EMBED_BATCH_ROWS = 8192  # Chunks projected (and assigned to clusters) at once
+
+
+@dataclass(frozen=True)
+class DenseIndex:
+    """Chunk embeddings plus the projection used to embed questions.
+
+    All arrays are plain numpy arrays so they can be saved as .npy files and
+    memory-mapped back; centroids and the list arrays are None when the
+    corpus is small enough to scan.
+    """
+    term_map: np.ndarray  # TF-IDF column -> row of components (-1 if unused)
+    components: np.ndarray  # (terms, dim) float32 projection
+    embeddings: np.ndarray  # (chunks, dim) float32, L2-normalised
+    centroids: np.ndarray = None  # (lists, dim) float32 cluster centres
+    list_offsets: np.ndarray = None  # Start of each cluster in list_members, plus the end
+    list_members: np.ndarray = None  # Chunk ids grouped by cluster
+
+    def arrays(self) -> dict:
+        """Return the arrays to persist, keyed by field name."""
+        return {name: value for name, value in vars(self).items() if value is not None}
+
+    def embed_query(self, query_vector):
+        """Project a 1-row TF-IDF vector into the embedding space, or return None."""
+        columns = self.term_map[query_vector.indices]
+        known = columns >= 0
+        if not known.any():
+            return None
+        embedding = query_vector.data[known].astype(np.float32) @ self.components[columns[known]]
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm > 0 else None
+
+    def search(self, query_vector, top_k: int = 5) -> list:
+        """Return up to top_k (chunk_id, cosine similarity) pairs, best first."""
+        query = self.embed_query(query_vector)
+        if query is None:
+            return []
+
+        if self.centroids is None:
+            candidates = None
+            scores = self.embeddings @ query
+        else:
+            centroid_scores = self.centroids @ query
+            probes = min(IVF_PROBES, len(centroid_scores))
+            lists = np.argpartition(-centroid_scores, probes - 1)[:probes]
+            candidates = np.concatenate([
+                self.list_members[self.list_offsets[l]:self.list_offsets[l + 1]] for l in lists
+            ])
+            scores = self.embeddings[candidates] @ query
+
+        k = min(top_k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        ids = top if candidates is None else candidates[top]
+        return [(int(i), float(scores[t])) for i, t in zip(ids, top)]
+
+
+def _sample_rows(n_rows: int, limit: int) -> np.ndarray:
+    if n_rows <= limit:
+        return np.arange(n_rows)
+    return np.sort(np.random.default_rng(0).choice(n_rows, limit, replace=False))
+
+
+def build_dense_index(tfidf):
+    """Fit embeddings for the rows of a TF-IDF matrix, or return None if it is too small."""
+    # Only building needs scikit-learn; loading and searching a saved index use numpy alone
+    from sklearn.cluster import MiniBatchKMeans
+    from sklearn.decomposition import TruncatedSVD
+    from sklearn.preprocessing import normalize
+
+    n_chunks, n_terms = tfidf.shape
+    df = np.bincount(tfidf.indices, minlength=n_terms)
+    columns = np.flatnonzero(df)
+    if len(columns) > DENSE_MAX_TERMS:
+        columns = np.sort(columns[np.argpartition(-df[columns], DENSE_MAX_TERMS - 1)[:DENSE_MAX_TERMS]])
+
+    dim = min(DENSE_DIM, n_chunks - 1, len(columns) - 1)
+    if dim < DENSE_MIN_DIM:
+        return None
+
+    reduced = tfidf[:, columns].tocsr()
+    svd = TruncatedSVD(n_components=dim, algorithm='randomized', random_state=0)
+    svd.fit(reduced[_sample_rows(n_chunks, SVD_SAMPLE_ROWS)])
+    components = np.ascontiguousarray(svd.components_.T, dtype=np.float32)
+
+    embeddings = np.empty((n_chunks, dim), dtype=np.float32)
+    for start in range(0, n_chunks, EMBED_BATCH_ROWS):
+        batch = reduced[start:start + EMBED_BATCH_ROWS] @ components
+        embeddings[start:start + EMBED_BATCH_ROWS] = normalize(batch)
+
+    term_map = np.full(n_terms, -1, dtype=np.int32)
+    term_map[columns] = np.arange(len(columns), dtype=np.int32)
+
+    if n_chunks < IVF_MIN_CHUNKS:
+        return DenseIndex(term_map, components, embeddings)
+
+    # Inverted file: about sqrt(n) clusters, each chunk listed under its nearest centre
+    n_lists = int(np.sqrt(n_chunks))
+    kmeans = MiniBatchKMeans(n_clusters=n_lists, batch_size=4096, n_init=1, random_state=0)
+    kmeans.fit(embeddings[_sample_rows(n_chunks, n_lists * 64)])
+    centroids = normalize(kmeans.cluster_centers_).astype(np.float32)
+
+    assignments = np.empty(n_chunks, dtype=np.int32)
+    for start in range(0, n_chunks, EMBED_BATCH_ROWS):
+        assignments[start:start + EMBED_BATCH_ROWS] = (embeddings[start:start + EMBED_BATCH_ROWS] @ centroids.T).argmax(axis=1)
+    list_members = np.argsort(assignments, kind='stable').astype(np.int32)
+    list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))]).astype(np.int64)
+
+    return DenseIndex(term_map, components, embeddings, centroids, list_offsets, list_members)
@@ -0,0 +1,157 @@
+"""
+Streaming HTML Text Extraction
+Pulls the main text out of a web page while it downloads. lxml's parser feeds
+start/end/text events straight into a collector without building a tree. The
+text is split into blocks at block-level tags, and blocks are kept when they
+look like content (enough words, mostly not link text) rather than by tag
+name. Parsing stops as soon as enough content has been collected.
+"""
+
+import re
+import codecs
+from lxml import etree
+
+BLOCK_TAGS = frozenset([
+    'address', 'article', 'aside', 'blockquote', 'body', 'br', 'dd', 'div', 'dl', 'dt', 'figcaption',
+    'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'main', 'nav', 'ol',
+    'p', 'pre', 'section', 'table', 'td', 'th', 'tr', 'ul'
+])
+SKIP_TAGS = frozenset(['script', 'style', 'noscript', 'template', 'svg', 'head', 'iframe', 'object'])
+MIN_BLOCK_WORDS = 10  # Shorter blocks are treated as navigation, captions or boilerplate
+MAX_LINK_DENSITY = 0.33  # Blocks with more of their text inside links are treated as menus
+FEED_BYTES = 16384  # Bytes parsed between checks for having enough text
+_CHARSET = re.compile(r'charset=["\']?([\w.:-]+)', re.IGNORECASE)
+# <meta charset="..."> or <meta http-equiv="Content-Type" content="text/html; charset=...">
+_META_CHARSET = re.compile(rb'<meta[^>]*?charset\s*=\s*["\']?\s*([\w.:-]+)', re.IGNORECASE)
+
+
+def charset_from_content_type(content_type: str):
+    """Return the charset declared in a Content-Type header, or None."""
+    match = _CHARSET.search(content_type or '')
+    return match.group(1) if match else None
+
+
+def charset_from_meta(head: bytes):
+    """Return the charset declared by a <meta> tag in the start of a page, or None."""
+    match = _META_CHARSET.search(head)
+    if not match:
+        return None
+    try:
+        name = codecs.lookup(match.group(1).decode('ascii')).name
+    except (LookupError, UnicodeDecodeError):
+        return None
+    # A page that could declare its charset in ASCII is not UTF-16, whatever it says
+    return 'utf-8' if name.startswith('utf-16') else name
+
+
+class _BlockCollector:
+    """lxml parser target that groups text into blocks and scores them as they close."""
+
+    def __init__(self):
+        self.blocks = []  # (text, is_content) in document order
+        self.content_chars = 0
+        self._skip_depth = 0
+        self._link_depth = 0
+        self._pieces = []
+        self._chars = 0
+        self._link_chars = 0
+
+    def start(self, tag, attrib):
+        tag = tag.lower() if isinstance(tag, str) else ''
+        if tag in SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag == 'a':
+            self._link_depth += 1
+        if tag in BLOCK_TAGS:
+            self._flush()
+
+    def end(self, tag):
+        tag = tag.lower() if isinstance(tag, str) else ''
+        if tag in SKIP_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag == 'a':
+            self._link_depth = max(0, self._link_depth - 1)
+        if tag in BLOCK_TAGS:
+            self._flush()
+
+    def data(self, text):
+        if self._skip_depth:
+            return
+        self._pieces.append(text)
+        chars = len(text.strip())
+        self._chars += chars
+        if self._link_depth:
+            self._link_chars += chars
+
+    def comment(self, text):
+        pass
+
+    def close(self):
+        self._flush()
+
+    def _flush(self):
+        if self._pieces:
+            text = " ".join("".join(self._pieces).split())
+            if text:
+                is_content = (len(text.split()) >= MIN_BLOCK_WORDS
+                              and self._link_chars <= MAX_LINK_DENSITY * max(self._chars, 1))
+                self.blocks.append((text, is_content))
+                if is_content:
+                    self.content_chars += len(text) + 1
+        self._pieces = []
+        self._chars = 0
+        self._link_chars = 0
+
+
+class MainTextExtractor:
+    """Incrementally extract up to limit characters of a page's main text.
+
+    Feed downloaded bytes with feed(); it returns True once enough content
+    has been found and the rest of the page can be skipped. text() returns
+    the result. Without an encoding (e.g. no charset in the Content-Type
+    header), the page's own <meta> declaration in the first chunk is used,
+    then UTF-8.
+    """
+
+    def __init__(self, limit: int = 2000, encoding: str = None):
+        self.limit = limit
+        self.encoding = encoding
+        self._collector = _BlockCollector()
+        self._parser = None  # Created on the first feed, once the encoding is known
+        self._closed = False
+
+    @property
+    def done(self) -> bool:
+        return self._collector.content_chars >= self.limit
+
+    def feed(self, data: bytes) -> bool:
+        if self._parser is None:
+            self.encoding = self.encoding or charset_from_meta(data) or 'utf-8'
+            self._parser = etree.HTMLParser(target=self._collector, encoding=self.encoding, remove_comments=True)
+        if not self.done:
+            self._parser.feed(data)
+        return self.done
+
+    def text(self) -> str:
+        if not self._closed:
+            self._closed = True
+            try:
+                if self._parser is not None:
+                    self._parser.close()
+            except etree.LxmlError:
+                self._collector.close()
+
+        blocks = self._collector.blocks
+        content = [text for text, is_content in blocks if is_content]
+        # Pages with no block long enough to look like content fall back to all of their text
+        text = " ".join(content or [text for text, _ in blocks])
+        return text[:self.limit]
+
+
+def extract_main_text(html: bytes, limit: int = 2000, encoding: str = None) -> str:
+    """Extract up to limit characters of main text from a complete HTML document."""
+    extractor = MainTextExtractor(limit, encoding)
+    for start in range(0, len(html), FEED_BYTES):
+        if extractor.feed(html[start:start + FEED_BYTES]):
+            break
+    return extractor.text()
@@ -0,0 +1,127 @@
+"""
+Persistent TF-IDF Index Store
+Saves the chatbot's sparse index to disk as plain .npy arrays so it can be
+memory-mapped on startup instead of being refitted, and updated
+incrementally when only some knowledge chunks change.
+"""
+
+import os
+import json
+import glob
+import time
+import uuid
+import hashlib
+import numpy as np
+from scipy import sparse
+
+MANIFEST_FILE = 'index.json'
+STALE_FILE_AGE = 60  # Seconds before files of a superseded index may be deleted
+
+
+def chunk_hash(chunk: str) -> str:
+    """Return the content hash used to key a chunk in the persisted index."""
+    return hashlib.sha1(chunk.encode('utf-8')).hexdigest()
+
+
+def _array_path(index_dir: str, name: str, tag: str) -> str:
+    return os.path.join(index_dir, f"{name}.{tag}.npy")
+
+
+def _save_csr(index_dir: str, prefix: str, matrix, tag: str):
+    """Save a CSR matrix as three .npy arrays that can be memory-mapped back."""
+    for part in ('data', 'indices', 'indptr'):
+        np.save(_array_path(index_dir, f"{prefix}_{part}", tag), getattr(matrix, part))
+
+
+def _load_csr(index_dir: str, prefix: str, shape: tuple, tag: str):
+    """Load a CSR matrix saved by _save_csr with its arrays memory-mapped."""
+    data, indices, indptr = (
+        np.load(_array_path(index_dir, f"{prefix}_{part}", tag), mmap_mode='r')
+        for part in ('data', 'indices', 'indptr')
+    )
+    return sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+
+def load_index(index_dir: str):
+    """Load a persisted index, or return None if there is none or it is unreadable.
+
+    The returned dict holds the chunk hashes, the vocabulary, the IDF vector,
+    the raw term-count and TF-IDF matrices and the term-by-chunk postings
+    (all memory-mapped), and the dense index arrays by name. Postings and
+    dense arrays are None for an index saved without them; the dense arrays
+    are empty if dense retrieval was tried but built nothing.
+    """
+    manifest_path = os.path.join(index_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+
+        tag = manifest['tag']
+        shape = (len(manifest['chunk_hashes']), len(manifest['vocabulary']))
+        return {
+            "generation": manifest['generation'],
+            "chunk_hashes": manifest['chunk_hashes'],
+            "vocabulary": manifest['vocabulary'],
+            "idf": np.load(_array_path(index_dir, 'idf', tag), mmap_mode='r'),
+            "counts": _load_csr(index_dir, 'counts', shape, tag),
+            "tfidf": _load_csr(index_dir, 'tfidf', shape, tag),
+            "postings": _load_csr(index_dir, 'postings', shape[::-1], tag) if manifest.get('postings') else None,
+            "dense": {
+                name: np.load(_array_path(index_dir, f"dense_{name}", tag), mmap_mode='r')
+                for name in manifest['dense']
+            } if manifest.get('dense') is not None else None
+        }
+    except Exception as e:
+        print(f"[Error loading persisted index: {e}]")
+        return None
+
+
+def save_index(index_dir: str, chunk_hashes: list, vocabulary: dict, idf, counts, tfidf,
+               previous_generation: int = 0, dense: dict = None, postings=None):
+    """Persist an index under a new generation and switch the manifest to it.
+
+    Arrays are written under file names unique to this save and the manifest is
+    replaced last, so readers never see a half-written index, several worker
+    processes can save at once, and files that are still memory-mapped by a
+    running process are never overwritten.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    generation = previous_generation + 1
+    tag = f"{generation}-{uuid.uuid4().hex[:8]}"
+
+    np.save(_array_path(index_dir, 'idf', tag), np.asarray(idf, dtype=np.float64))
+    _save_csr(index_dir, 'counts', counts, tag)
+    _save_csr(index_dir, 'tfidf', tfidf, tag)
+    if postings is not None:
+        _save_csr(index_dir, 'postings', postings, tag)
+    for name, array in (dense or {}).items():
+        np.save(_array_path(index_dir, f"dense_{name}", tag), array)
+
+    manifest_path = os.path.join(index_dir, MANIFEST_FILE)
+    tmp_path = f"{manifest_path}.{tag}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            "generation": generation,
+            "tag": tag,
+            "chunk_hashes": chunk_hashes,
+            "vocabulary": vocabulary,
+            "dense": list(dense) if dense is not None else None,
+            "postings": postings is not None
+        }, f)
+    os.replace(tmp_path, manifest_path)
+
+    # Superseded files may still be mapped (and locked on Windows) or belong to
+    # a save in progress in another process, so only old ones are removed
+    cutoff = time.time() - STALE_FILE_AGE
+    for path in glob.glob(os.path.join(index_dir, '*.npy')):
+        if not path.endswith(f".{tag}.npy"):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    return generation
@@ -0,0 +1,233 @@
+"""
+Knowledge Corpus Ingestion
+Streams a knowledge file or a directory of text, Markdown and HTML documents
+into overlapping chunks tagged with the document they came from, sharding the
+work across a process pool so memory stays bounded by the batch size.
+"""
+
+import os
+import re
+from collections import deque
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+
+from index_store import chunk_hash
+
+TEXT_EXTENSIONS = ('.txt', '.md', '.markdown')
+HTML_EXTENSIONS = ('.html', '.htm')
+SHARD_BYTES = 1 << 20  # Large text files are split into ~1 MB shards at blank lines
+MAX_PENDING_SHARDS = 2  # Shards in flight per worker before results must be consumed
+CHUNK_TOKENS = 60  # Words per chunk
+OVERLAP_TOKENS = 10  # Words of trailing sentences repeated at the start of the next chunk
+_PARAGRAPH_BREAK = re.compile(rb'\r?\n[ \t]*\r?\n')
+_SENTENCE_END = re.compile(r'([.!?]+["\'\)\]]*)(?:\s+|$)|\n[ \t]*\r?\n\s*')
+_NON_SPACE = re.compile(r'\S')
+_WORD = re.compile(r'\S+')
+
+
+def _count_words(text: str, start: int, end: int) -> int:
+    """Count the words in text[start:end] (which has no surrounding whitespace) without copying it.
+
+    Runs of several spaces make this overcount slightly, which only makes chunks a little shorter.
+    """
+    return text.count(' ', start, end) + text.count('\n', start, end) + text.count('\t', start, end) + 1
+
+
+def _iter_sentences(text: str, max_tokens: int):
+    """Yield (start, end, tokens) spans of the sentences in text.
+
+    A sentence ends at terminal punctuation followed by whitespace (so "4.5"
+    is not a boundary) or at a blank line. Tokens are whitespace-separated
+    words; sentences longer than max_tokens are cut into max_tokens pieces.
+    """
+    first = _NON_SPACE.search(text)
+    start = first.start() if first else len(text)
+    # Each boundary match also consumes the whitespace after it, so the next sentence starts at its end
+    for boundary in chain(_SENTENCE_END.finditer(text, start), (None,)):
+        if boundary is None:
+            end = next_start = len(text)
+        elif boundary.group(1) is not None:
+            end, next_start = boundary.end(1), boundary.end()
+        else:
+            end, next_start = boundary.start(), boundary.end()
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        if end > start:
+            tokens = _count_words(text, start, end)
+            if tokens <= max_tokens:
+                yield start, end, tokens
+            else:
+                words = [(word.start(), word.end()) for word in _WORD.finditer(text, start, end)]
+                for i in range(0, len(words), max_tokens):
+                    piece = words[i:i + max_tokens]
+                    yield piece[0][0], piece[-1][1], len(piece)
+        start = next_start
+
+
+def iter_chunk_spans(text: str, chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = OVERLAP_TOKENS):
+    """Yield (start, end) character spans of overlapping chunks of text.
+
+    Chunks are runs of whole sentences of at most chunk_tokens words. Each
+    chunk after the first starts with the trailing sentences of the previous
+    one, up to overlap_tokens words. Every sentence enters and leaves the
+    window once, so this is linear in the length of text.
+    """
+    window = deque()
+    window_tokens = 0
+    for sentence in _iter_sentences(text, chunk_tokens):
+        tokens = sentence[2]
+        if window and window_tokens + tokens > chunk_tokens:
+            yield window[0][0], window[-1][1]
+            while window and (window_tokens > overlap_tokens or window_tokens + tokens > chunk_tokens):
+                window_tokens -= window.popleft()[2]
+        window.append(sentence)
+        window_tokens += tokens
+
+    if window:
+        yield window[0][0], window[-1][1]
+
+
+def iter_chunks(text: str, chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = OVERLAP_TOKENS):
+    """Split text into overlapping chunks, yielding (offset, chunk) pairs.
+
+    Each chunk is the slice of text it covers, punctuation included, and the
+    offset is the character position in text where it starts.
+    """
+    for start, end in iter_chunk_spans(text, chunk_tokens, overlap_tokens):
+        yield start, text[start:end]
+
+
+def chunk_text(text: str, chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = OVERLAP_TOKENS) -> list:
+    """Split text into overlapping chunks for TF-IDF processing."""
+    return [chunk for _, chunk in iter_chunks(text, chunk_tokens, overlap_tokens)]
+
+
+def iter_documents(path: str):
+    """Yield the knowledge documents under path (a single file or a directory)."""
+    if os.path.isfile(path):
+        yield path
+        return
+
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(TEXT_EXTENSIONS + HTML_EXTENSIONS):
+                yield os.path.join(root, name)
+
+
+def corpus_signature(path: str):
+    """Return a value that changes whenever the corpus at path changes, or None if it is missing."""
+    if not os.path.exists(path):
+        return None
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    count, latest, total = 0, 0, 0
+    for doc in iter_documents(path):
+        stat = os.stat(doc)
+        count += 1
+        latest = max(latest, stat.st_mtime_ns)
+        total += stat.st_size
+    return (count, latest, total)
+
+
+def html_to_text(html) -> str:
+    """Extract readable text from an HTML document."""
+    from bs4 import BeautifulSoup
+    
+    soup = BeautifulSoup(html, 'html.parser')
+    for tag in soup(["script", "style", "nav", "header", "footer", "aside"]):
+        tag.decompose()
+    lines = (line.strip() for line in soup.get_text().splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def _iter_shards(doc: str):
+    """Yield (path, start, end) byte ranges that can be chunked independently.
+
+    Text files larger than SHARD_BYTES are cut at the first paragraph break
+    after each SHARD_BYTES boundary so no paragraph is split between shards.
+    """
+    size = os.path.getsize(doc)
+    if doc.lower().endswith(HTML_EXTENSIONS) or size <= SHARD_BYTES:
+        yield doc, 0, size
+        return
+
+    with open(doc, 'rb') as f:
+        start = 0
+        while start < size:
+            end = start + SHARD_BYTES
+            if end < size:
+                f.seek(end)
+                window = b""
+                while True:
+                    block = f.read(65536)
+                    if not block:
+                        end = size
+                        break
+                    window += block
+                    match = _PARAGRAPH_BREAK.search(window)
+                    if match and match.end() < len(window):
+                        end += match.end()
+                        break
+            end = min(end, size)
+            yield doc, start, end
+            start = end
+
+
+def _chunk_shard(shard: tuple, chunk_tokens: int, overlap_tokens: int) -> list:
+    """Chunk one shard and return (chunk, metadata) pairs.
+
+    Offsets are byte offsets into the file; for HTML documents they are
+    character offsets into the extracted text. The id is the chunk's content
+    hash, so it stays the same wherever the chunk moves in the corpus.
+    """
+    doc, start, end = shard
+
+    with open(doc, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    if doc.lower().endswith(HTML_EXTENSIONS):
+        text = html_to_text(data.decode('utf-8', errors='replace'))
+        return [(chunk, {"doc": doc, "offset": offset, "id": chunk_hash(chunk)})
+                for offset, chunk in iter_chunks(text, chunk_tokens, overlap_tokens)]
+
+    text = data.decode('utf-8', errors='replace')
+    chunks = []
+    char_pos, byte_pos = 0, start
+    for offset, chunk in iter_chunks(text, chunk_tokens, overlap_tokens):
+        # Offsets only move forward, so the byte position is advanced incrementally
+        byte_pos += len(text[char_pos:offset].encode('utf-8'))
+        char_pos = offset
+        chunks.append((chunk, {"doc": doc, "offset": byte_pos, "id": chunk_hash(chunk)}))
+    return chunks
+
+
+def iter_corpus_chunks(path: str, chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = OVERLAP_TOKENS,
+                       workers: int = None):
+    """Stream (chunk, metadata) pairs for every document under path, in document order.
+
+    Shards are processed by a pool of worker processes with a bounded number
+    of results pending at once. A corpus that fits in one shard is chunked
+    in-process to avoid the pool start-up cost.
+    """
+    shards = (shard for doc in iter_documents(path) for shard in _iter_shards(doc))
+    first = next(shards, None)
+    second = next(shards, None)
+    if first is None:
+        return
+    if second is None:
+        yield from _chunk_shard(first, chunk_tokens, overlap_tokens)
+        return
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for shard in chain((first, second), shards):
+            pending.append(executor.submit(_chunk_shard, shard, chunk_tokens, overlap_tokens))
+            if len(pending) >= workers * MAX_PENDING_SHARDS:
+                yield from pending.pop(0).result()
+        for future in pending:
+            yield from future.result()
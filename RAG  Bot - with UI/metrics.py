@@ -0,0 +1,106 @@
+"""
+Request Metrics
+Timing spans for the stages of answering a question, aggregated into
+Prometheus-style histograms and, while a request trace is active, collected
+per request so they can be returned alongside the answer.
+"""
+
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+_TRACE = contextvars.ContextVar('rag_trace', default=None)
+
+
+class Histogram:
+    """Cumulative histogram with one set of buckets per label value."""
+
+    def __init__(self, name: str, description: str, label: str, buckets: tuple):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = buckets
+        self._series = {}  # label value -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, value: float):
+        with self._lock:
+            series = self._series.setdefault(label_value, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[len(self.buckets)] += 1
+            series[-1] += value
+
+    def render(self) -> list:
+        """Return the histogram in the Prometheus text exposition format."""
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for label_value, values in sorted(series.items()):
+            label = f'{self.label}="{label_value}"'
+            for bound, count in zip(self.buckets, values):
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {values[len(self.buckets)]}')
+            lines.append(f"{self.name}_sum{{{label}}} {values[-1]}")
+            lines.append(f"{self.name}_count{{{label}}} {values[len(self.buckets)]}")
+        return lines
+
+
+STAGE_SECONDS = Histogram('rag_stage_duration_seconds', 'Time spent in each stage of answering a question.',
+                          'stage', LATENCY_BUCKETS)
+OLLAMA_TOKENS = Histogram('rag_ollama_tokens', 'Prompt and generated token counts per Ollama call.',
+                          'kind', TOKEN_BUCKETS)
+
+
+@contextmanager
+def span(stage: str):
+    """Time a block (or, used as a decorator, each call) as one occurrence of stage."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(stage, elapsed)
+        trace = _TRACE.get()
+        if trace is not None:
+            trace["spans"].append({"stage": stage, "ms": round(elapsed * 1000, 3)})
+
+
+def record_ollama_tokens(prompt_tokens: int, eval_tokens: int):
+    """Record the token counts Ollama reported for one call."""
+    OLLAMA_TOKENS.observe('prompt', prompt_tokens)
+    OLLAMA_TOKENS.observe('eval', eval_tokens)
+    trace = _TRACE.get()
+    if trace is not None:
+        trace["prompt_eval_count"] = trace.get("prompt_eval_count", 0) + prompt_tokens
+        trace["eval_count"] = trace.get("eval_count", 0) + eval_tokens
+
+
+@contextmanager
+def request_trace():
+    """Collect the spans of the current request into the yielded dict."""
+    trace = {"spans": []}
+    token = _TRACE.set(trace)
+    try:
+        yield trace
+    finally:
+        _TRACE.reset(token)
+
+
+def propagate(fn):
+    """Wrap fn so spans it records on another thread join the caller's trace."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+def render_metrics(gauges: dict = None) -> str:
+    """Render every histogram, plus the given {name: (description, value)} gauges."""
+    lines = STAGE_SECONDS.render() + OLLAMA_TOKENS.render()
+    for name, (description, value) in (gauges or {}).items():
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
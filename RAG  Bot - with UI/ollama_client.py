@@ -0,0 +1,201 @@
+"""
+Ollama Backend Pool
+Spreads generations across one or more Ollama servers. Each backend keeps
+its own keep-alive connection pool, and every request goes to the available
+backend with the fewest requests outstanding. Failures are tracked passively:
+a backend that fails FAILURE_THRESHOLD times in a row is taken out of
+rotation for COOLDOWN_SECONDS (its circuit opens), then let back in with a
+single probe request. Requests that cannot connect are retried on another
+backend. The same pool serves threads (requests) and asyncio tasks (httpx).
+"""
+
+import time
+import threading
+from contextlib import asynccontextmanager, contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:  # Optional: only the async server needs it
+    httpx = None
+
+FAILURE_THRESHOLD = 3  # Consecutive failures that take a backend out of rotation
+COOLDOWN_SECONDS = 15.0  # How long a failing backend stays out before it is probed again
+POOL_CONNECTIONS = 8  # Keep-alive connections kept per backend
+
+
+class OllamaUnavailableError(Exception):
+    """Raised when every backend is out of rotation or has already been tried."""
+
+
+class OllamaBackend:
+    """One Ollama server: its connection pool, load and health."""
+
+    def __init__(self, url: str, pool_size: int = POOL_CONNECTIONS):
+        self.url = url.rstrip('/')
+        self.outstanding = 0
+        self.failures = 0  # Consecutive failures
+        self.open_until = 0.0  # Monotonic time the circuit stays open until (0 while closed)
+        self.probing = False  # A half-open probe request is in flight
+        self.stats = {"requests": 0, "failures": 0, "retried": 0, "circuit_opens": 0}
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def state(self, now: float = None) -> str:
+        """'closed' (in rotation), 'open' (cooling down) or 'half-open' (ready for a probe)."""
+        if not self.open_until:
+            return 'closed'
+        return 'open' if (now or time.monotonic()) < self.open_until else 'half-open'
+
+
+class OllamaPool:
+    """Least-outstanding-requests routing with circuit breaking over a list of backends."""
+
+    def __init__(self, urls: list, pool_size: int = POOL_CONNECTIONS, failure_threshold: int = FAILURE_THRESHOLD,
+                 cooldown: float = COOLDOWN_SECONDS):
+        if not urls:
+            raise ValueError("At least one Ollama backend URL is required")
+        self.backends = [OllamaBackend(url, pool_size) for url in urls]
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._turn = 0  # Rotates the tie-break between equally loaded backends
+
+    def _acquire(self, tried: list) -> OllamaBackend:
+        """Reserve the least loaded available backend not in tried."""
+        now = time.monotonic()
+        with self._lock:
+            count = len(self.backends)
+            candidates = []
+            for i, backend in enumerate(self.backends):
+                state = backend.state(now)
+                if backend in tried or state == 'open' or (state == 'half-open' and backend.probing):
+                    continue
+                candidates.append((backend.outstanding, (i - self._turn) % count, backend))
+            if not candidates:
+                raise OllamaUnavailableError("No Ollama backend is available")
+            backend = min(candidates, key=lambda candidate: candidate[:2])[2]
+            self._turn = (self._turn + 1) % count
+            if backend.state(now) == 'half-open':
+                backend.probing = True
+            backend.outstanding += 1
+            backend.stats["requests"] += 1
+            return backend
+
+    def _release(self, backend: OllamaBackend, ok: bool = None):
+        """Return a backend reserved by _acquire, recording whether the request succeeded (None: no verdict)."""
+        with self._lock:
+            backend.outstanding -= 1
+            backend.probing = False
+            if ok is None:
+                return
+            if ok:
+                if backend.open_until:
+                    print(f"[Ollama backend {backend.url} recovered]")
+                backend.failures = 0
+                backend.open_until = 0.0
+                return
+            backend.failures += 1
+            backend.stats["failures"] += 1
+            # A failed probe reopens the circuit straight away
+            if backend.failures >= self.failure_threshold or backend.open_until:
+                backend.open_until = time.monotonic() + self.cooldown
+                backend.stats["circuit_opens"] += 1
+                print(f"[Ollama backend {backend.url} failing, out of rotation for {self.cooldown:.0f}s]")
+
+    def _next_backend(self, tried: list, error: Exception) -> OllamaBackend:
+        """Pick a backend for the next attempt, re-raising the last connection error once none is left."""
+        try:
+            backend = self._acquire(tried)
+        except OllamaUnavailableError:
+            if error is not None:
+                raise error
+            raise
+        if error is not None:
+            backend.stats["retried"] += 1
+            print(f"[Retrying on Ollama backend {backend.url}]")
+        tried.append(backend)
+        return backend
+
+    @contextmanager
+    def request(self, path: str, payload: dict, timeout: float, stream: bool = False):
+        """POST payload to path on the chosen backend and yield the response.
+
+        The backend stays reserved until the block exits, so streamed
+        responses count as outstanding while they are read. Connection
+        failures are retried on another backend; 5xx responses and errors
+        while reading count against the backend's health.
+        """
+        tried, error = [], None
+        while True:
+            backend = self._next_backend(tried, error)
+            try:
+                response = backend.session.post(backend.url + path, json=payload, timeout=timeout, stream=stream)
+                break
+            except requests.exceptions.ConnectionError as e:
+                self._release(backend, False)
+                error = e
+            except requests.exceptions.RequestException:
+                self._release(backend, False)
+                raise
+
+        ok = response.status_code < 500
+        try:
+            yield response
+        except requests.exceptions.HTTPError:
+            raise  # Judged by the status code above
+        except (requests.exceptions.RequestException, ValueError):
+            ok = False
+            raise
+        finally:
+            response.close()
+            self._release(backend, ok)
+
+    @asynccontextmanager
+    async def request_async(self, client, path: str, payload: dict, timeout: float, stream: bool = False):
+        """Async counterpart of request, sent through the given httpx.AsyncClient."""
+        tried, error = [], None
+        while True:
+            backend = self._next_backend(tried, error)
+            try:
+                request = client.build_request('POST', backend.url + path, json=payload, timeout=timeout)
+                response = await client.send(request, stream=stream)
+                break
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                self._release(backend, False)
+                error = e
+            except httpx.HTTPError:
+                self._release(backend, False)
+                raise
+            except BaseException:
+                # Cancelled while connecting: says nothing about the backend's health
+                self._release(backend)
+                raise
+
+        ok = response.status_code < 500
+        try:
+            yield response
+        except httpx.HTTPStatusError:
+            raise  # Judged by the status code above
+        except (httpx.HTTPError, ValueError):
+            ok = False
+            raise
+        finally:
+            await response.aclose()
+            self._release(backend, ok)
+
+    def stats(self) -> list:
+        """Return the load, health and counters of every backend."""
+        now = time.monotonic()
+        with self._lock:
+            return [{"url": backend.url, "state": backend.state(now), "outstanding": backend.outstanding,
+                     "consecutive_failures": backend.failures, **backend.stats} for backend in self.backends]
+
+    def available_count(self) -> int:
+        """Number of backends currently in rotation or ready for a probe."""
+        now = time.monotonic()
+        with self._lock:
+            return sum(backend.state(now) != 'open' for backend in self.backends)
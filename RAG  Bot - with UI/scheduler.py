@@ -0,0 +1,198 @@
+"""
+Ollama Request Scheduler
+Bounds how many generations run against Ollama at once. Extra requests wait
+in a first-come-first-served queue until their deadline, and are rejected
+up front when the queue is already full. Threads and asyncio tasks can share
+one scheduler.
+"""
+
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+
+class OllamaBusyError(Exception):
+    """Raised when a request cannot get an Ollama slot.
+
+    status is the HTTP status to answer with (429 when the queue was full,
+    503 when the request's deadline passed while queued) and retry_after a
+    suggested number of seconds to wait before retrying.
+    """
+
+    def __init__(self, message: str, status: int, retry_after: int):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    """A queued request: a thread blocked on an event, or a task awaiting a future."""
+    __slots__ = ('event', 'future', 'loop', 'granted')
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.event = None if loop else threading.Event()
+        self.future = loop.create_future() if loop else None
+        self.granted = False
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class RequestScheduler:
+    """Concurrency limiter with a fair, bounded queue and wait-time metrics."""
+
+    def __init__(self, max_in_flight: int = 1, max_queue: int = 16, default_deadline: float = 30.0):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.default_deadline = default_deadline
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._queue = deque()
+        self._wait_times = deque(maxlen=1000)  # Recent queue waits in seconds
+        self._service_time = 10.0  # Moving average of seconds a slot is held
+        self._stats = {"admitted": 0, "rejected_full": 0, "rejected_deadline": 0, "max_queue_depth": 0}
+
+    def _retry_after(self) -> int:
+        """Estimate seconds until a new request would be admitted."""
+        backlog = len(self._queue) + 1
+        return max(1, int(self._service_time * backlog / self.max_in_flight + 0.5))
+
+    def check_capacity(self):
+        """Raise OllamaBusyError now if a new request would be rejected."""
+        with self._lock:
+            if self._in_flight >= self.max_in_flight and len(self._queue) >= self.max_queue:
+                self._stats["rejected_full"] += 1
+                raise OllamaBusyError("Ollama queue is full", 429, self._retry_after())
+
+    def _enqueue(self, loop=None):
+        """Take a free slot (returning None) or queue a waiter, raising 429 if the queue is full."""
+        with self._lock:
+            if self._in_flight < self.max_in_flight and not self._queue:
+                self._in_flight += 1
+                self._stats["admitted"] += 1
+                self._wait_times.append(0.0)
+                return None
+            if len(self._queue) >= self.max_queue:
+                self._stats["rejected_full"] += 1
+                raise OllamaBusyError("Ollama queue is full", 429, self._retry_after())
+            waiter = _Waiter(loop)
+            self._queue.append(waiter)
+            self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], len(self._queue))
+            return waiter
+
+    def _finish_wait(self, waiter: _Waiter, started: float):
+        """Admit a waiter that was granted a slot, or drop it from the queue and raise 503."""
+        with self._lock:
+            self._wait_times.append(time.monotonic() - started)
+            if waiter.granted:
+                self._stats["admitted"] += 1
+                return
+            self._queue.remove(waiter)
+            self._stats["rejected_deadline"] += 1
+            raise OllamaBusyError("Timed out waiting for an Ollama slot", 503, self._retry_after())
+
+    def acquire(self, deadline: float = None):
+        """Wait for a slot; deadline is in seconds from now (default_deadline if None)."""
+        deadline = self.default_deadline if deadline is None else deadline
+        started = time.monotonic()
+        waiter = self._enqueue()
+        if waiter is None:
+            return
+        waiter.event.wait(deadline)
+        self._finish_wait(waiter, started)
+
+    async def acquire_async(self, deadline: float = None):
+        """Like acquire, but waits without blocking the event loop."""
+        deadline = self.default_deadline if deadline is None else deadline
+        started = time.monotonic()
+        waiter = self._enqueue(asyncio.get_running_loop())
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), deadline)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # The client went away: give up the place in the queue, or the slot if it just arrived
+            with self._lock:
+                granted = waiter.granted
+                if not granted:
+                    self._queue.remove(waiter)
+            if granted:
+                self.release()
+            raise
+        self._finish_wait(waiter, started)
+
+    def release(self, held_for: float = None):
+        """Free a slot, handing it straight to the longest-waiting request if any."""
+        with self._lock:
+            if held_for is not None:
+                self._service_time = 0.8 * self._service_time + 0.2 * held_for
+            # After the limit shrinks (see resize), slots are retired instead of handed on
+            if self._queue and self._in_flight <= self.max_in_flight:
+                waiter = self._queue.popleft()
+                waiter.granted = True
+                waiter.wake()
+            else:
+                self._in_flight -= 1
+
+    def resize(self, max_in_flight: int):
+        """Change the in-flight limit, admitting queued requests straight away if it grew."""
+        with self._lock:
+            self.max_in_flight = max_in_flight
+            while self._queue and self._in_flight < max_in_flight:
+                waiter = self._queue.popleft()
+                waiter.granted = True
+                self._in_flight += 1
+                waiter.wake()
+
+    @contextmanager
+    def slot(self, deadline: float = None):
+        """Hold a slot for the duration of a with-block."""
+        self.acquire(deadline)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    @asynccontextmanager
+    async def async_slot(self, deadline: float = None):
+        """Hold a slot for the duration of an async with-block."""
+        await self.acquire_async(deadline)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    def stats(self) -> dict:
+        """Return queue depth, in-flight count, admission counters and wait-time percentiles."""
+        with self._lock:
+            waits = sorted(self._wait_times)
+            in_flight, depth = self._in_flight, len(self._queue)
+            stats = dict(self._stats)
+
+        def percentile(p):
+            return waits[min(len(waits) - 1, int(p * len(waits)))] if waits else 0.0
+
+        return {
+            **stats,
+            "in_flight": in_flight,
+            "queue_depth": depth,
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "wait_p50": percentile(0.5),
+            "wait_p95": percentile(0.95),
+            "wait_max": waits[-1] if waits else 0.0
+        }